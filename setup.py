@@ -10,7 +10,8 @@ setup(
         "loguru",
         "msal",
         "python-dotenv",
-        "openpyxl",
+        "openpyxl==3.1.5",
+        "xlrd",
         "pytest",
         "pytest-cov",
         "pytest-html",
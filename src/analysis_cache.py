@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+from typing import List
+
+from src.models.sheet_analysis import SheetAnalysis
+
+ANALYSIS_CACHE_DIRECTORY = os.path.join("cache", "analysis")
+# Increase whenever the analysis output changes so stale results aren't replayed
+ANALYSIS_CACHE_VERSION = 5
+
+
+# Analyses are saved per workbook and per analysis settings, so changing a setting doesn't replay old results
+def get_analysis_key(content_hash: str, settings: dict):
+    settings_hash = hashlib.sha256(
+        json.dumps(settings, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return content_hash + "-" + settings_hash[:16]
+
+
+def get_analysis_path(analysis_key: str):
+    return os.path.join(ANALYSIS_CACHE_DIRECTORY, analysis_key + ".json")
+
+
+def load_analysis(analysis_key: str):
+    analysis_path = get_analysis_path(analysis_key)
+    if not os.path.exists(analysis_path):
+        return None
+
+    with open(analysis_path, "r", encoding="utf-8") as file:
+        cached_analysis = json.load(file)
+    if cached_analysis.get("version") != ANALYSIS_CACHE_VERSION:
+        return None
+
+    sheet_analyses: List[SheetAnalysis] = []
+    for cached_sheet in cached_analysis["sheets"]:
+        sheet_analysis = SheetAnalysis()
+        sheet_analysis.__dict__.update(cached_sheet)
+        sheet_analyses.append(sheet_analysis)
+    return sheet_analyses
+
+
+def save_analysis(analysis_key: str, sheet_analyses: List[SheetAnalysis]):
+    if not os.path.exists(ANALYSIS_CACHE_DIRECTORY):
+        os.makedirs(ANALYSIS_CACHE_DIRECTORY, exist_ok=True)
+
+    analysis_path = get_analysis_path(analysis_key)
+    # Written to a temporary file first so an interrupted write can't corrupt the cache
+    temp_path = analysis_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "version": ANALYSIS_CACHE_VERSION,
+                "sheets": [vars(sheet_analysis) for sheet_analysis in sheet_analyses],
+            },
+            file,
+        )
+    os.replace(temp_path, analysis_path)
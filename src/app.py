@@ -1,16 +1,20 @@
 import base64
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from logging import Logger
-from typing import List
+from typing import List, Tuple
 
 import hydra
 from loguru import logger
 
-import requests
-from msal import PublicClientApplication
 from omegaconf import DictConfig
 
+from src import blob_store, http_client
+from src.token_manager import TokenManager
 from src.models.attachment import Attachment
 from src.models.message import Message, Body, EmailAddress
 from src.inventory_generator import generate_inventory
@@ -20,6 +24,22 @@ REFRESH_TOKEN = ""
 OUTPUT_DIRECTORY = ""
 SYSTEM_LOGGER: Logger = None
 CONFIG: DictConfig = None
+TOKEN_MANAGER: TokenManager = None
+GRAPH_BATCH_API = "https://graph.microsoft.com/v1.0/$batch"
+# Graph accepts at most 20 sub-requests in a single JSON batch
+GRAPH_BATCH_SIZE = 20
+GRAPH_BATCH_MAX_ATTEMPTS = 5
+GRAPH_RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+LIST_MESSAGES_HEADERS = {
+    "Prefer": "outlook.body-content-type='text', odata.maxpagesize=100"
+}
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+DELTA_LINK_PATH = os.path.join("cache", "delta_link.json")
+# Delta link received in this run, saved only once the run has completed
+PENDING_DELTA_LINK = ""
+ARCHIVE_WORKERS = 2
+ARCHIVE_EXECUTOR: ThreadPoolExecutor = None
+ARCHIVE_FUTURES: List[Future] = []
 
 
 @hydra.main(version_base=None, config_path="./", config_name="config")
@@ -69,94 +89,97 @@ def get_tokens():
     return ACCESS_TOKEN, REFRESH_TOKEN
 
 
-def create_temp_directory():
-    if not os.path.exists("./temp"):
-        os.makedirs("./temp")
-    else:
-        li = os.listdir(os.path.join("temp"))
-        for item in li:
-            try:
-                os.remove(os.path.join("temp", item))
-            except:
-                pass
-
-
-def process_messages():
-    messages: List[Message] = []
+def list_message_pages():
+    global PENDING_DELTA_LINK
+    incremental = CONFIG.app_config.get("incremental", False)
+    delta_link = load_delta_link() if incremental else ""
     before = timedelta(days=CONFIG.app_config.days)
     current_datetime = datetime.now(timezone.utc)
     received_after_datetime = (
         (current_datetime - before).isoformat().replace("+00:00", "Z")
     )
-    list_messages_api = f"https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?$filter=receivedDateTime ge {received_after_datetime}&$select=id,bodyPreview,body,hasAttachments,sender,from,toRecipients,receivedDateTime&$top=100"
+    # Delta queries only support filtering on receivedDateTime, so messages without attachments are skipped later
+    list_messages_api = f"https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages{'/delta' if incremental else ''}?$filter=receivedDateTime ge {received_after_datetime}{'' if incremental else ' and hasAttachments eq true'}&$select=id,bodyPreview,body,hasAttachments,sender,from,toRecipients,receivedDateTime{'' if incremental else '&$top=100'}"
 
-    print(
-        f"⏳ Downloading messages received on or after {(current_datetime - before).strftime('%d/%m/%Y %H:%M:%S')} (UTC)"
-    )
-    response = api_request(
-        list_messages_api, {"Prefer": "outlook.body-content-type='text'"}
-    )
-    response = append_messages_or_retry(response, messages, list_messages_api)
+    messages: List[Message] = []
+    response = None
+    if delta_link:
+        print("⏳ Downloading messages received or changed since the last run")
+        response = api_request(delta_link, LIST_MESSAGES_HEADERS)
+        if "error" in response and response["error"].get("code") in [
+            "SyncStateNotFound",
+            "SyncStateInvalid",
+            "resyncRequired",
+        ]:
+            # The saved delta link has expired, so a full sync is started again
+            response = None
+        else:
+            response = append_messages_or_retry(response, messages, delta_link)
+
+    if response is None:
+        print(
+            f"⏳ Downloading messages received on or after {(current_datetime - before).strftime('%d/%m/%Y %H:%M:%S')} (UTC)"
+        )
+        response = api_request(list_messages_api, LIST_MESSAGES_HEADERS)
+        response = append_messages_or_retry(response, messages, list_messages_api)
+    yield messages
 
     while "@odata.nextLink" in response:
         nextLink = response["@odata.nextLink"]
-        response = api_request(nextLink, {"Prefer": "outlook.body-content-type='text'"})
+        messages = []
+        response = api_request(nextLink, LIST_MESSAGES_HEADERS)
         response = append_messages_or_retry(response, messages, nextLink)
+        yield messages
 
-    print(
-        f"✅ Downloaded {len(messages)} {'messages' if len(messages) > 1 else 'message'}"
-    )
+    if "@odata.deltaLink" in response:
+        PENDING_DELTA_LINK = response["@odata.deltaLink"]
 
-    number_of_messages_with_attachments = 0
-    if len(messages) > 0:
-        messages_with_attachments = [
-            message for message in messages if message.has_attachments
-        ]
-        number_of_messages_with_attachments = len(messages_with_attachments)
-        if number_of_messages_with_attachments > 0:
-            print(
-                f"[INFO] {number_of_messages_with_attachments} {'messages' if number_of_messages_with_attachments > 1 else 'message'} contains attachments."
-            )
-            print("⏳ Downloading attachments")
 
-    message_counter = 0
-    for message in messages:
-        message_counter += 1
+def download_message_attachments(messages: List[Message], message_counter: int = 0):
+    messages_with_attachments = [
+        message for message in messages if message.has_attachments
+    ]
 
-        if message.has_attachments:
-            list_attachments_api = (
-                "https://graph.microsoft.com/v1.0/me/messages/"
-                + message.id
-                + "/attachments"
-            )
-            response = api_request(list_attachments_api)
-            append_attachments_or_retry(response, message, list_attachments_api)
+    # Only the attachment metadata is listed first so that non-Excel payloads are never downloaded
+    download_in_batches(download_attachments, messages_with_attachments)
 
-    if number_of_messages_with_attachments:
-        print("✅ Attachments downloaded")
+    excel_attachments: List[Tuple[Message, Attachment]] = []
+    for message in messages_with_attachments:
+        for attachment in message.attachments:
+            if attachment.is_excel_file:
+                message.has_excel_files = True
+                excel_attachments.append((message, attachment))
+    message_counter = set_attachment_paths(messages, message_counter)
+    download_in_parallel(download_attachment_content, excel_attachments)
+    return message_counter
 
-        number_of_messages_with_excel_files = 0
-        for message in messages:
-            if message.has_attachments:
-                for attachment in message.attachments:
-                    if attachment.name.endswith(".xls") or attachment.name.endswith(
-                        ".xlsx"
-                    ):
-                        number_of_messages_with_excel_files += 1
-                        message.has_excel_files = True
-                        break
 
-        print(
-            f"[INFO] {number_of_messages_with_excel_files} {'messages' if number_of_messages_with_excel_files > 1 else 'message'} contains Excel files in attachments."
-        )
+def stream_messages():
+    # Each page is downloaded and saved while the messages of earlier pages are being analysed
+    message_counter = 0
+    for page_messages in list_message_pages():
+        first_message_counter = message_counter
+        message_counter = download_message_attachments(page_messages, message_counter)
+        save_messages(page_messages, first_message_counter)
 
-    return messages
+        excel_messages = [
+            message for message in page_messages if message.has_excel_files
+        ]
+        if len(excel_messages) > 0:
+            print(
+                f"[INFO] Downloaded {len(excel_messages)} {'messages' if len(excel_messages) > 1 else 'message'} with Excel files in attachments."
+            )
+        yield from excel_messages
 
 
 def append_messages(response, messages: List[Message]):
     response_messages = response["value"]
     if len(response_messages) > 0:
         for message in response_messages:
+            # Delta queries also report deleted messages, which carry no content
+            if "@removed" in message:
+                continue
+
             body = Body(message["body"]["content"], message["body"]["contentType"])
             sender = EmailAddress(
                 message["sender"]["emailAddress"]["name"],
@@ -196,6 +219,7 @@ def append_messages(response, messages: List[Message]):
 
 
 def append_messages_or_retry(response, messages: List[Message], url: str):
+    expired_access_token = get_access_token()
     try:
         append_messages(response, messages)
     except:
@@ -204,66 +228,272 @@ def append_messages_or_retry(response, messages: List[Message], url: str):
             and "code" in response["error"]
             and response["error"]["code"] == "InvalidAuthenticationToken"
         ):
-            result = app.acquire_token_silent(
-                scopes=SCOPES, account=app.get_accounts()[0]
-            )
-            set_tokens(result["access_token"], result["refresh_token"])
-            response = api_request(url, {"Prefer": "outlook.body-content-type='text'"})
+            refresh_tokens(expired_access_token)
+            response = api_request(url, LIST_MESSAGES_HEADERS)
             append_messages(response, messages)
         else:
             raise
     return response
 
 
+def download_in_parallel(download, items: list):
+    with ThreadPoolExecutor(
+        max_workers=CONFIG.app_config.get("max_workers", 8)
+    ) as executor:
+        # Consuming the results re-raises the first failure from the workers
+        list(executor.map(download, items))
+
+
+def download_in_batches(download, items: list):
+    # Requests are coalesced into Graph batches which are sent in parallel
+    download_in_parallel(
+        download,
+        [
+            items[skip : skip + GRAPH_BATCH_SIZE]
+            for skip in range(0, len(items), GRAPH_BATCH_SIZE)
+        ],
+    )
+
+
+def download_attachments(messages: List[Message]):
+    api_batch_get(
+        {
+            str(message_index): "/me/messages/"
+            + message.id
+            + "/attachments?$select=id,name,contentType,size"
+            for message_index, message in enumerate(messages)
+        },
+        lambda request_id, body: append_attachments(body, messages[int(request_id)]),
+    )
+
+
+def download_attachment_content(message_attachment: Tuple[Message, Attachment]):
+    message, attachment = message_attachment
+    attachment_content_api = (
+        "https://graph.microsoft.com/v1.0/me/messages/"
+        + message.id
+        + "/attachments/"
+        + attachment.id
+        + "/$value"
+    )
+    expired_access_token = get_access_token()
+    response = api_stream_request(attachment_content_api)
+    if response.status_code == 401:
+        response.close()
+        refresh_tokens(expired_access_token)
+        response = api_stream_request(attachment_content_api)
+
+    with response:
+        if response.status_code != 200:
+            raise Exception(
+                f"Couldn't download the attachment {attachment.name}: {response.status_code} - {response.text}"
+            )
+
+        # Small attachments are analysed straight from memory and archived in the background
+        if is_in_memory_attachment(attachment):
+            attachment.content = b"".join(
+                response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE)
+            )
+            attachment.content_hash = hashlib.sha256(attachment.content).hexdigest()
+            return
+
+        # The raw content is written in chunks so it's never held in memory as a whole
+        attachment.content_hash = blob_store.store_chunks(
+            response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE)
+        )
+    blob_store.link_blob(attachment.content_hash, attachment.path)
+
+
+def is_in_memory_attachment(attachment: Attachment):
+    return (
+        attachment.size is not None
+        and attachment.size
+        <= CONFIG.app_config.get("max_in_memory_attachment_mb", 32) * 1024 * 1024
+    )
+
+
+def archive_attachment(attachment: Attachment, attachment_path: str):
+    global ARCHIVE_EXECUTOR
+    if not CONFIG.app_config.get("archive_attachments", True):
+        attachment.path = None
+        return
+
+    if ARCHIVE_EXECUTOR is None:
+        ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS)
+    attachment.path = attachment_path
+    ARCHIVE_FUTURES.append(
+        ARCHIVE_EXECUTOR.submit(save_attachment, attachment.content, attachment_path)
+    )
+
+
+def save_attachment(content: bytes, attachment_path: str):
+    blob_store.link_blob(blob_store.store_bytes(content), attachment_path)
+
+
+def wait_for_archived_attachments():
+    for future in ARCHIVE_FUTURES:
+        try:
+            future.result()
+        except Exception as ex:
+            SYSTEM_LOGGER.info("\nCouldn't archive an attachment\n")
+            SYSTEM_LOGGER.exception(ex)
+    ARCHIVE_FUTURES.clear()
+
+
+def api_batch_get(urls: dict[str, str], append_response):
+    pending_urls = dict(urls)
+    attempts = 0
+    while len(pending_urls) > 0:
+        attempts += 1
+        if attempts > GRAPH_BATCH_MAX_ATTEMPTS:
+            raise Exception(
+                f"Couldn't complete {len(pending_urls)} Graph "
+                f"{'requests' if len(pending_urls) > 1 else 'request'} "
+                f"after {GRAPH_BATCH_MAX_ATTEMPTS} attempts"
+            )
+
+        expired_access_token = get_access_token()
+        response = api_batch_request(
+            [
+                {"id": request_id, "method": "GET", "url": url}
+                for request_id, url in pending_urls.items()
+            ]
+        )
+
+        if "responses" not in response:
+            if (
+                "error" in response
+                and "code" in response["error"]
+                and response["error"]["code"] == "InvalidAuthenticationToken"
+            ):
+                refresh_tokens(expired_access_token)
+                continue
+            raise Exception(f"Graph batch request failed: {response}")
+
+        retry_after = 0
+        for sub_response in response["responses"]:
+            status = int(sub_response["status"])
+            if status == 200:
+                pending_urls.pop(sub_response["id"])
+                append_response(sub_response["id"], sub_response["body"])
+            elif status == 401:
+                # Only the failed sub-requests are sent again with the new token
+                refresh_tokens(expired_access_token)
+            elif status in GRAPH_RETRYABLE_STATUS_CODES:
+                headers = sub_response.get("headers") or {}
+                retry_after = max(retry_after, int(headers.get("Retry-After", 1)))
+            else:
+                raise Exception(
+                    f"Graph request {pending_urls[sub_response['id']]} failed: {sub_response.get('body')}"
+                )
+
+        if len(pending_urls) > 0 and retry_after > 0:
+            time.sleep(retry_after)
+
+
 def append_attachments(response, message: Message):
     message.attachments = []
     for attachment in response["value"]:
         if attachment["@odata.type"] == "#microsoft.graph.fileAttachment":
             content = Attachment(
-                attachment["name"], base64.b64decode(attachment["contentBytes"])
+                attachment["name"],
+                (
+                    base64.b64decode(attachment["contentBytes"])
+                    if "contentBytes" in attachment
+                    else None
+                ),
+                attachment.get("id"),
+                attachment.get("contentType"),
+                attachment.get("size"),
             )
             message.attachments.append(content)
 
 
-def append_attachments_or_retry(response, message: Message, url: str):
-    try:
-        append_attachments(response, message)
-    except:
-        if (
-            "error" in response
-            and "code" in response["error"]
-            and response["error"]["code"] == "InvalidAuthenticationToken"
-        ):
-            result = app.acquire_token_silent(
-                scopes=SCOPES, account=app.get_accounts()[0]
-            )
-            set_tokens(result["access_token"], result["refresh_token"])
-            response = api_request(url)
-            append_attachments(response, message)
-        else:
-            raise
+def get_access_token():
+    if TOKEN_MANAGER is not None:
+        return TOKEN_MANAGER.get_access_token()
+    return ACCESS_TOKEN
+
+
+def refresh_tokens(expired_access_token: str):
+    TOKEN_MANAGER.refresh(expired_access_token)
 
 
 def api_request(url: str, header_list: dict[str, str] = dict()):
-    headers = {"Authorization": "Bearer " + ACCESS_TOKEN}
+    headers = {"Authorization": "Bearer " + get_access_token()}
     for header in header_list.keys():
         headers[header] = header_list.get(header)
-    response = requests.get(url=url, headers=headers)
+    response = http_client.get(url=url, headers=headers)
     response_json = response.json()
     return response_json
 
 
-def save_messages(messages: List[Message]):
+def api_stream_request(url: str):
+    headers = {"Authorization": "Bearer " + get_access_token()}
+    return http_client.get(url=url, headers=headers, stream=True)
+
+
+def api_batch_request(sub_requests: List[dict]):
+    headers = {
+        "Authorization": "Bearer " + get_access_token(),
+        "Content-Type": "application/json",
+    }
+    response = http_client.post(
+        url=GRAPH_BATCH_API, headers=headers, json={"requests": sub_requests}
+    )
+    response_json = response.json()
+    return response_json
+
+
+def load_delta_link():
+    if not os.path.exists(DELTA_LINK_PATH):
+        return ""
+    try:
+        with open(DELTA_LINK_PATH, "r", encoding="utf-8") as file:
+            return json.load(file)["delta_link"]
+    except Exception as ex:
+        SYSTEM_LOGGER.debug(ex)
+        return ""
+
+
+def save_delta_link():
+    if not PENDING_DELTA_LINK:
+        return
+    if not os.path.exists(os.path.dirname(DELTA_LINK_PATH)):
+        os.makedirs(os.path.dirname(DELTA_LINK_PATH))
+    # Written to a temporary file first so an interrupted write can't corrupt the saved link
+    temp_path = DELTA_LINK_PATH + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump({"delta_link": PENDING_DELTA_LINK}, file)
+    os.replace(temp_path, DELTA_LINK_PATH)
+
+
+def get_message_directory(message_number: int):
+    return os.path.join(OUTPUT_DIRECTORY, "Messages", "Message " + str(message_number))
+
+
+def set_attachment_paths(messages: List[Message], message_counter: int = 0):
+    for message in messages:
+        if message.has_excel_files:
+            message_counter += 1
+            for attachment in message.attachments:
+                if attachment.is_excel_file:
+                    attachment.path = os.path.join(
+                        get_message_directory(message_counter),
+                        "Attachments",
+                        attachment.name,
+                    )
+    return message_counter
+
+
+def save_messages(messages: List[Message], message_counter: int = 0):
     if not os.path.exists(os.path.join(OUTPUT_DIRECTORY, "Messages")):
         os.makedirs(os.path.join(OUTPUT_DIRECTORY, "Messages"))
 
-    message_counter = 0
     for message in messages:
         if message.has_excel_files:
             message_counter += 1
-            message_directory = os.path.join(
-                OUTPUT_DIRECTORY, "Messages", "Message " + str(message_counter)
-            )
+            message_directory = get_message_directory(message_counter)
             if not os.path.exists(message_directory):
                 os.makedirs(message_directory)
             file_path = os.path.join(
@@ -282,17 +512,12 @@ def save_messages(messages: List[Message]):
                     os.makedirs(attachments_directory)
 
                 for attachment in message.attachments:
-                    if attachment.name.lower().endswith(
-                        ".xlsx"
-                    ) or attachment.name.lower().endswith(".xls"):
-                        attachment_path = os.path.join(
-                            attachments_directory, attachment.name
+                    # Attachments streamed from Graph are already saved at their path
+                    if attachment.is_excel_file and attachment.is_in_memory:
+                        archive_attachment(
+                            attachment,
+                            os.path.join(attachments_directory, attachment.name),
                         )
-                        if os.path.exists(attachment_path):
-                            os.remove(attachment_path)
-                        file = open(attachment_path, "w+b")
-                        file.write(attachment.content)
-                        file.close()
 
 
 if __name__ == "__main__":
@@ -325,28 +550,20 @@ if __name__ == "__main__":
                 "price_runner_token: Your PriceRunner's Product Token\n"
             )
         else:
-            app = PublicClientApplication(
-                CONFIG.secrets.client_id,
-                authority="https://login.microsoftonline.com/common/",
-            )
-            SCOPES = ["Mail.Read"]
-            flow = app.initiate_device_flow(scopes=SCOPES)
-            print(f"🚀 {flow['message']}")
-            result = app.acquire_token_by_device_flow(flow)
+            TOKEN_MANAGER = TokenManager(CONFIG.secrets.client_id, ["Mail.Read"])
+            result = TOKEN_MANAGER.sign_in()
 
             if "access_token" in result:
-                set_tokens(result["access_token"], result["refresh_token"])
-                create_temp_directory()
-
-                messages = process_messages()
-                if len(messages) > 0:
-                    save_messages(messages)
-                    generate_inventory(
-                        OUTPUT_DIRECTORY,
-                        [message for message in messages if message.has_excel_files],
-                        SYSTEM_LOGGER,
-                        CONFIG,
-                    )
+                set_tokens(result["access_token"], result.get("refresh_token", ""))
+
+                generate_inventory(
+                    OUTPUT_DIRECTORY,
+                    stream_messages(),
+                    SYSTEM_LOGGER,
+                    CONFIG,
+                )
+                wait_for_archived_attachments()
+                save_delta_link()
                 print("✅ Done")
             else:
                 print(
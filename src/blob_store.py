@@ -0,0 +1,57 @@
+import hashlib
+import os
+import shutil
+import uuid
+from typing import Iterable
+
+BLOB_STORE_DIRECTORY = os.path.join("cache", "blobs")
+
+
+def get_blob_path(content_hash: str):
+    # Blobs are fanned out by the first two hex digits to keep directories small
+    return os.path.join(BLOB_STORE_DIRECTORY, content_hash[:2], content_hash)
+
+
+def store_chunks(chunks: Iterable[bytes]):
+    temp_directory = os.path.join(BLOB_STORE_DIRECTORY, "tmp")
+    if not os.path.exists(temp_directory):
+        os.makedirs(temp_directory, exist_ok=True)
+
+    sha256 = hashlib.sha256()
+    temp_path = os.path.join(temp_directory, uuid.uuid4().hex)
+    try:
+        with open(temp_path, "wb") as file:
+            for chunk in chunks:
+                sha256.update(chunk)
+                file.write(chunk)
+
+        content_hash = sha256.hexdigest()
+        blob_path = get_blob_path(content_hash)
+        if os.path.exists(blob_path):
+            # Same content was stored before, possibly in an earlier run
+            os.remove(temp_path)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return content_hash
+
+
+def store_bytes(content: bytes):
+    return store_chunks([content])
+
+
+def link_blob(content_hash: str, path: str):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(get_blob_path(content_hash), path)
+    except OSError:
+        # Hard links aren't available on every file system (or across devices)
+        shutil.copyfile(get_blob_path(content_hash), path)
@@ -0,0 +1,495 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from openai import OpenAI, APIError, NotFoundError
+from openai.types.beta import Thread
+
+from src.prompt_builder import CHARACTERS_PER_TOKEN
+
+HEADER_KEYS = ["barcode", "quantity", "product", "price"]
+# model="ft:gpt-3.5-turbo-0125:vallabha-systems-limited:header-prediction:9lFHETSg"
+# Latest
+HEADER_ANALYSIS_MODEL = (
+    "ft:gpt-3.5-turbo-0125:vallabha-systems-limited:header-prediction:9nk6uHeF"
+)
+HEADER_ANALYSIS_INSTRUCTIONS = 'You are a sales data assistant who identifies the header row (i.e., The CSV line) and provides four headers from a CSV (Comma Separated Values) file content in the JSON dict format: {"barcode": <Barcode_Column>, "quantity": <Quantity_Column>, "product": <Product_Column>, "price": <Price_Column>}. Each property relates to Barcode, Quantity, Product description and Price column headers respectively in the CSV file. The synonym of the header\'s words, or sometimes abbreviations, should match the requirement. For example, the header for Barcode (a GTIN) could be EAN, UPC, GTIN, etc. The header for Quantity could be Quantity, Stock, Pieces, PCS, QTY, Units, etc. The header for Price could be Price, Unit Price, Cost, etc. The header for Product could be Product, Name, Description, Item, DESC, etc. The result values should strictly be from the same row which is considered as header row and not different rows. You could also look the the column\'s values to verify if most of them relate to what you decide the column\'s header is. For example, you can verify the column header for Barcode by not only looking at the header\'s words, but also if most of that column\'s values has valid barcodes (GTIN). If you could not find a suitable value for a property, set an empty string to that.'
+ASSISTANT_NAME = "Sales Data Analyser"
+ASSISTANT_PATH = os.path.join("cache", "assistant.json")
+HEADER_ANALYSIS_PROMPT = "Please provide me the four headers from the header row that relate to Barcode, Product, Quantity and Price in a JSON dict format by analysing the given CSV content:\n"
+# Only models that support structured outputs accept a JSON schema
+HEADER_RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "headers",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {key: {"type": "string"} for key in HEADER_KEYS},
+            "required": HEADER_KEYS,
+            "additionalProperties": False,
+        },
+    },
+}
+MULTI_SHEET_INSTRUCTIONS = ' The content can have several sheets, each one starting with a line like "### Sheet 1". The headers of each sheet are found separately and provided in a JSON dict of the sheet numbers: {"1": {"barcode": <Barcode_Column>, "quantity": <Quantity_Column>, "product": <Product_Column>, "price": <Price_Column>}, "2": {...}}.'
+MULTI_SHEET_PROMPT = "Please provide me the four headers from the header row of each sheet that relate to Barcode, Product, Quantity and Price in a JSON dict of the sheet numbers by analysing the given CSV content:\n"
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 300
+DEFAULT_BATCH_POLL_SECONDS = 60
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_PENDING_STATUSES = ["validating", "in_progress", "finalizing"]
+DEFAULT_MULTI_SHEET_TOKENS = 12000
+
+
+def parse_response(text: str):
+    try:
+        response = json.loads(str(text).strip().strip("```json").strip())
+        return {key: str(response.get(key) or "") for key in HEADER_KEYS}
+    except:
+        return None
+
+
+# Returns the headers of each sheet, or None for the sheets missing from the response
+def parse_sheets_response(text: str, number_of_sheets: int):
+    try:
+        sheets = json.loads(str(text).strip().strip("```json").strip())
+    except:
+        return [None] * number_of_sheets
+    if not isinstance(sheets, dict):
+        return [None] * number_of_sheets
+    return [
+        (
+            parse_response(json.dumps(sheets[str(number)]))
+            if isinstance(sheets.get(str(number)), dict)
+            else None
+        )
+        for number in range(1, number_of_sheets + 1)
+    ]
+
+
+def create_chat_request(model: str, response_format: dict, csv_content: str):
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": HEADER_ANALYSIS_INSTRUCTIONS},
+            {"role": "user", "content": HEADER_ANALYSIS_PROMPT + csv_content},
+        ],
+        "response_format": response_format,
+        "temperature": 0,
+    }
+
+
+def get_response_format(json_schema: bool):
+    return HEADER_RESPONSE_SCHEMA if json_schema else {"type": "json_object"}
+
+
+def create_sheets_request(model: str, response_format: dict, csv_contents: List[str]):
+    content = "".join(
+        f"### Sheet {number}\n{csv_content}"
+        for number, csv_content in enumerate(csv_contents, start=1)
+    )
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": HEADER_ANALYSIS_INSTRUCTIONS + MULTI_SHEET_INSTRUCTIONS,
+            },
+            {"role": "user", "content": MULTI_SHEET_PROMPT + content},
+        ],
+        "response_format": response_format,
+        "temperature": 0,
+    }
+
+
+def get_sheets_response_format(json_schema: bool, number_of_sheets: int):
+    if not json_schema:
+        return {"type": "json_object"}
+    sheet_numbers = [str(number) for number in range(1, number_of_sheets + 1)]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "sheet_headers",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    sheet_number: HEADER_RESPONSE_SCHEMA["json_schema"]["schema"]
+                    for sheet_number in sheet_numbers
+                },
+                "required": sheet_numbers,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+# Returns whether the analysis completed and the headers, if any were found
+def read_completion(finish_reason: str, content: str):
+    if finish_reason != "stop":
+        return False, None
+    return True, parse_response(content)
+
+
+class RateLimiter:
+
+    def __init__(self, max_concurrency: int, requests_per_minute: float):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        # Requests are spaced evenly rather than sent in bursts
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.lock = threading.Lock()
+        self.next_request_at = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_request_at - now
+            self.next_request_at = max(now, self.next_request_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
+class ChatHeaderAnalyser:
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model: str = HEADER_ANALYSIS_MODEL,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        json_schema: bool = False,
+    ):
+        self.client = client
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(max_concurrency, requests_per_minute)
+        self.response_format = get_response_format(json_schema)
+
+    def analyse(self, csv_content: str):
+        choice = self.create_completion(
+            create_chat_request(self.model, self.response_format, csv_content)
+        )
+        if choice is None:
+            return False, None
+        return read_completion(choice.finish_reason, choice.message.content)
+
+    def create_completion(self, request: dict):
+        try:
+            with self.rate_limiter:
+                completion = self.client.chat.completions.create(**request)
+        except APIError:
+            return None
+        return completion.choices[0]
+
+
+# Sends the sheets of a message together, in as few requests as fit in the token budget.
+# The prompts are collected first, like the batch analyser, and then submitted at once
+class MultiSheetHeaderAnalyser(ChatHeaderAnalyser):
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model: str = HEADER_ANALYSIS_MODEL,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        json_schema: bool = False,
+        max_tokens: int = DEFAULT_MULTI_SHEET_TOKENS,
+    ):
+        super().__init__(
+            client, model, max_concurrency, requests_per_minute, json_schema
+        )
+        self.json_schema = json_schema
+        self.max_tokens = max_tokens
+        self.collecting = False
+        self.pending_prompts: dict[str, str] = {}
+        self.results: dict[str, tuple] = {}
+        self.lock = threading.Lock()
+
+    # Results of the previous message aren't needed anymore
+    def start_collecting(self):
+        with self.lock:
+            self.collecting = True
+            self.results = {}
+
+    def stop_collecting(self):
+        with self.lock:
+            self.collecting = False
+            self.pending_prompts = {}
+
+    def analyse(self, csv_content: str):
+        custom_id = hashlib.sha256(csv_content.encode("utf-8")).hexdigest()
+        with self.lock:
+            if custom_id in self.results:
+                return self.results[custom_id]
+            if self.collecting:
+                self.pending_prompts[custom_id] = csv_content
+                return False, None
+        # Sheets that weren't collected beforehand are sent on their own
+        return super().analyse(csv_content)
+
+    def has_pending_prompts(self):
+        return len(self.pending_prompts) > 0
+
+    def submit(self):
+        with self.lock:
+            pending_prompts = self.pending_prompts
+            self.pending_prompts = {}
+
+        # Sheets are added to a request until the next one doesn't fit in the budget
+        requests: List[List[tuple]] = []
+        number_of_tokens = 0
+        for custom_id, csv_content in pending_prompts.items():
+            prompt_tokens = len(csv_content) / CHARACTERS_PER_TOKEN
+            if len(requests) == 0 or number_of_tokens + prompt_tokens > self.max_tokens:
+                requests.append([])
+                number_of_tokens = 0
+            requests[-1].append((custom_id, csv_content))
+            number_of_tokens += prompt_tokens
+        if len(requests) == 0:
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(requests))
+        ) as executor:
+            request_results = list(
+                executor.map(
+                    lambda request: self.analyse_sheets(
+                        [csv_content for _, csv_content in request]
+                    ),
+                    requests,
+                )
+            )
+        with self.lock:
+            for request, results in zip(requests, request_results):
+                for (custom_id, _), result in zip(request, results):
+                    self.results[custom_id] = result
+
+    def analyse_sheets(self, csv_contents: List[str]):
+        choice = self.create_completion(
+            create_sheets_request(
+                self.model,
+                get_sheets_response_format(self.json_schema, len(csv_contents)),
+                csv_contents,
+            )
+        )
+        if choice is None or choice.finish_reason != "stop":
+            return [(False, None)] * len(csv_contents)
+        return [
+            (True, response)
+            for response in parse_sheets_response(
+                choice.message.content, len(csv_contents)
+            )
+        ]
+
+
+def run_openai_batch(
+    client: OpenAI, batch_input: str, poll_seconds: float = DEFAULT_BATCH_POLL_SECONDS
+):
+    batch_file = client.files.create(
+        file=("header_analysis.jsonl", io.BytesIO(batch_input.encode("utf-8"))),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    print(f"⏳ Waiting for the header analysis batch {batch.id}")
+    while batch.status in BATCH_PENDING_STATUSES:
+        time.sleep(poll_seconds)
+        batch = client.batches.retrieve(batch.id)
+
+    # Failed requests are only written to the error file, so they are missing from the output
+    if batch.output_file_id is None:
+        return ""
+    return client.files.content(batch.output_file_id).text
+
+
+class BatchHeaderAnalyser:
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model: str = HEADER_ANALYSIS_MODEL,
+        json_schema: bool = False,
+        poll_seconds: float = DEFAULT_BATCH_POLL_SECONDS,
+        run_batch: Callable[[str], str] = None,
+    ):
+        self.model = model
+        self.response_format = get_response_format(json_schema)
+        # Takes the batch input JSONL and returns the output JSONL
+        self.run_batch = run_batch or (
+            lambda batch_input: run_openai_batch(client, batch_input, poll_seconds)
+        )
+        self.pending_prompts: dict[str, str] = {}
+        self.results: dict[str, tuple] = {}
+        # Analysing a sheet doesn't send a request, so there's nothing to run at the same time
+        self.max_concurrency = 1
+        self.lock = threading.Lock()
+
+    # Sheets that weren't part of a submitted batch are incomplete until the next batch
+    def analyse(self, csv_content: str):
+        custom_id = hashlib.sha256(csv_content.encode("utf-8")).hexdigest()
+        with self.lock:
+            if custom_id in self.results:
+                return self.results[custom_id]
+            self.pending_prompts[custom_id] = csv_content
+            return False, None
+
+    def has_pending_prompts(self):
+        return len(self.pending_prompts) > 0
+
+    def submit(self):
+        with self.lock:
+            pending_prompts = self.pending_prompts
+            self.pending_prompts = {}
+        if len(pending_prompts) == 0:
+            return
+
+        batch_input = "".join(
+            json.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": create_chat_request(
+                        self.model, self.response_format, csv_content
+                    ),
+                }
+            )
+            + "\n"
+            for custom_id, csv_content in pending_prompts.items()
+        )
+        results = {custom_id: (False, None) for custom_id in pending_prompts}
+        for line in self.run_batch(batch_input).splitlines():
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            response = output.get("response") or {}
+            if output["custom_id"] in results and response.get("status_code") == 200:
+                choice = response["body"]["choices"][0]
+                results[output["custom_id"]] = read_completion(
+                    choice["finish_reason"], choice["message"]["content"]
+                )
+        with self.lock:
+            self.results.update(results)
+
+
+def get_assistant_hash(model: str):
+    assistant = {
+        "name": ASSISTANT_NAME,
+        "instructions": HEADER_ANALYSIS_INSTRUCTIONS,
+        "model": model,
+    }
+    return hashlib.sha256(json.dumps(assistant).encode("utf-8")).hexdigest()
+
+
+class AssistantHeaderAnalyser:
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model: str = HEADER_ANALYSIS_MODEL,
+        assistant_path: str = ASSISTANT_PATH,
+    ):
+        self.client = client
+        self.model = model
+        self.assistant_path = assistant_path
+        self.assistant_hash = get_assistant_hash(model)
+        # The assistant is only looked up once a sheet needs to be analysed
+        self.assistant_id: str = None
+        self.thread: Thread = None
+        # A thread holds a single conversation, so sheets are analysed one at a time
+        self.max_concurrency = 1
+        self.lock = threading.Lock()
+
+    # The same assistant is reused across runs until its instructions or model change
+    def get_assistant_id(self):
+        if self.assistant_id is None:
+            self.assistant_id = self.load_assistant_id()
+        if self.assistant_id is None:
+            self.assistant_id = self.initiate_assistant()
+        return self.assistant_id
+
+    def load_assistant_id(self):
+        if not os.path.exists(self.assistant_path):
+            return None
+        with open(self.assistant_path, "r", encoding="utf-8") as file:
+            saved_assistant = json.load(file)
+        if saved_assistant["hash"] == self.assistant_hash:
+            return saved_assistant["assistant_id"]
+
+        # The outdated assistant is removed so they don't accumulate on the account
+        try:
+            self.client.beta.assistants.delete(saved_assistant["assistant_id"])
+        except APIError:
+            pass
+        return None
+
+    def save_assistant_id(self, assistant_id: str):
+        if not os.path.exists(os.path.dirname(self.assistant_path)):
+            os.makedirs(os.path.dirname(self.assistant_path), exist_ok=True)
+        temp_path = self.assistant_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"assistant_id": assistant_id, "hash": self.assistant_hash}, file)
+        os.replace(temp_path, self.assistant_path)
+
+    def initiate_assistant(self):
+        assistant = self.client.beta.assistants.create(
+            name=ASSISTANT_NAME,
+            instructions=HEADER_ANALYSIS_INSTRUCTIONS,
+            model=self.model,
+        )
+        self.save_assistant_id(assistant.id)
+        return assistant.id
+
+    def reinitialize_thread(self):
+        for message in self.client.beta.threads.messages.list(thread_id=self.thread.id):
+            try:
+                self.client.beta.threads.messages.delete(
+                    thread_id=self.thread.id, message_id=message.id
+                )
+            except:
+                pass
+
+    def analyse(self, csv_content: str):
+        with self.lock:
+            if self.thread is None:
+                self.thread = self.client.beta.threads.create()
+            else:
+                self.reinitialize_thread()
+
+            self.client.beta.threads.messages.create(
+                thread_id=self.thread.id,
+                role="user",
+                content=HEADER_ANALYSIS_PROMPT + csv_content,
+            )
+            try:
+                run = self.client.beta.threads.runs.create_and_poll(
+                    assistant_id=self.get_assistant_id(), thread_id=self.thread.id
+                )
+            except NotFoundError:
+                # The saved assistant was deleted from the account
+                self.assistant_id = self.initiate_assistant()
+                run = self.client.beta.threads.runs.create_and_poll(
+                    assistant_id=self.assistant_id, thread_id=self.thread.id
+                )
+            if run.status != "completed":
+                return False, None
+
+            response_messages = self.client.beta.threads.messages.list(
+                thread_id=self.thread.id
+            )
+            if len(response_messages.data) == 0:
+                return True, None
+            return True, parse_response(response_messages.data[0].content[0].text.value)
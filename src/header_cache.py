@@ -0,0 +1,113 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+HEADER_CACHE_PATH = os.path.join("cache", "header_cache.json")
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL_DAYS = 90
+# Number of rows from the top of a sheet searched for header rows
+FINGERPRINT_ROWS = 50
+MAX_FINGERPRINT_HEADER_ROWS = 5
+
+
+def get_cell_text(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return re.sub(r"\s+", " ", str(value)).strip()
+
+
+def is_number(text: str):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def get_candidate_header_rows(rows: List[list]):
+    candidate_header_rows = []
+    for row in rows[:FINGERPRINT_ROWS]:
+        cells = [(index, get_cell_text(value)) for index, value in enumerate(row)]
+        cells = [(index, text) for index, text in cells if text]
+        text_cells = [(index, text) for index, text in cells if not is_number(text)]
+        # Header rows are mostly labels, whereas data rows mix in quantities, prices and barcodes
+        if len(cells) >= 2 and len(text_cells) * 3 > len(cells) * 2:
+            candidate_header_rows.append(cells)
+            if len(candidate_header_rows) == MAX_FINGERPRINT_HEADER_ROWS:
+                break
+    return candidate_header_rows
+
+
+def get_fingerprint(rows: List[list], sender: str = None):
+    candidate_header_rows = get_candidate_header_rows(rows)
+    if len(candidate_header_rows) == 0:
+        return None
+    layout = {"rows": candidate_header_rows, "sender": sender}
+    return hashlib.sha256(
+        json.dumps(layout, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class HeaderCache:
+
+    def __init__(
+        self,
+        path: str = HEADER_CACHE_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_days: float = DEFAULT_TTL_DAYS,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl_days * 24 * 60 * 60
+        # Least recently used entries come first
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.entries = OrderedDict(json.load(file))
+
+    def save(self):
+        with self.lock:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(list(self.entries.items()), file)
+            os.replace(temp_path, self.path)
+
+    def get(self, fingerprint: str):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None and time.time() - entry["saved_at"] > self.ttl:
+                del self.entries[fingerprint]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(fingerprint)
+            return dict(entry["response"])
+
+    def put(self, fingerprint: str, response: dict):
+        with self.lock:
+            self.entries[fingerprint] = {"response": response, "saved_at": time.time()}
+            self.entries.move_to_end(fingerprint)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups > 0 else 0
+        return f"Header cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), {len(self.entries)} layouts"
@@ -0,0 +1,169 @@
+import math
+import re
+from typing import List
+
+HEADER_KEYS = ["barcode", "quantity", "product", "price"]
+
+# Same synonyms the header analysis assistant is instructed with
+HEADER_SYNONYMS = {
+    "barcode": [
+        "barcode",
+        "bar code",
+        "ean",
+        "ean13",
+        "ean code",
+        "upc",
+        "upc code",
+        "gtin",
+        "gtin13",
+        "gtin14",
+    ],
+    "quantity": [
+        "quantity",
+        "qty",
+        "stock",
+        "pieces",
+        "pcs",
+        "units",
+        "available",
+        "available qty",
+        "stock qty",
+        "qty available",
+    ],
+    "product": [
+        "product",
+        "product name",
+        "product description",
+        "name",
+        "description",
+        "item",
+        "item description",
+        "desc",
+        "article",
+    ],
+    "price": [
+        "price",
+        "unit price",
+        "cost",
+        "unit cost",
+        "sale price",
+        "offer price",
+        "net price",
+    ],
+}
+SAMPLE_ROWS = 50
+# Number of values below a header checked against the expected type of the column
+SAMPLE_VALUES = 20
+GTIN_LENGTHS = [8, 12, 13, 14]
+
+
+def normalize(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return re.sub(r"[^a-z0-9]+", " ", str(value).lower()).strip()
+
+
+def to_number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return None if math.isnan(value) else float(value)
+    try:
+        return float(str(value).strip().lstrip("£€$").replace(",", ""))
+    except ValueError:
+        return None
+
+
+def is_gtin(value):
+    number = to_number(value)
+    if number is None or number < 0 or not float(number).is_integer():
+        return False
+    digits = str(int(number))
+    if len(digits) < GTIN_LENGTHS[0] or len(digits) > GTIN_LENGTHS[-1]:
+        return False
+    # Leading zeros are lost when barcodes are stored as numbers
+    digits = digits.zfill(
+        min(length for length in GTIN_LENGTHS if length >= len(digits))
+    )
+    checksum = 0
+    for index, digit in enumerate(reversed(digits[:-1])):
+        checksum += int(digit) * (3 if index % 2 == 0 else 1)
+    return (10 - checksum % 10) % 10 == int(digits[-1])
+
+
+def get_header_score(key: str, header: str):
+    normalized_header = normalize(header)
+    if not normalized_header:
+        return 0.0
+    if normalized_header in HEADER_SYNONYMS[key]:
+        return 1.0
+    # Headers such as "Sale Price £" or "EAN Code (13)" contain a synonym as a word
+    words = " " + normalized_header + " "
+    if any(" " + synonym + " " in words for synonym in HEADER_SYNONYMS[key]):
+        return 0.8
+    return 0.0
+
+
+def get_value_score(key: str, values: list):
+    values = [value for value in values if normalize(value)]
+    if len(values) == 0:
+        return 0.0
+    if key == "barcode":
+        matches = [value for value in values if is_gtin(value)]
+    elif key == "quantity":
+        matches = [
+            value
+            for value in values
+            if to_number(value) is not None and float(to_number(value)).is_integer()
+        ]
+    elif key == "price":
+        matches = [value for value in values if to_number(value) is not None]
+    else:
+        matches = [value for value in values if to_number(value) is None]
+    return len(matches) / len(values)
+
+
+# Finds the header row with the synonym rules and checks the values below each header.
+# Returns the response in the header analysis format and a confidence between 0 and 1
+def detect_headers_locally(rows: List[list]):
+    best_response = {key: "" for key in HEADER_KEYS}
+    best_confidence = 0.0
+    sample_rows = rows[:SAMPLE_ROWS]
+    for row_index, row in enumerate(sample_rows):
+        column_values = [
+            [
+                below_row[column_index] if column_index < len(below_row) else None
+                for below_row in rows[row_index + 1 : row_index + 1 + SAMPLE_VALUES]
+            ]
+            for column_index in range(len(row))
+        ]
+
+        response = {key: "" for key in HEADER_KEYS}
+        scores = {key: 0.0 for key in HEADER_KEYS}
+        used_columns = set()
+        for key in HEADER_KEYS:
+            best_column_index = None
+            for column_index, header in enumerate(row):
+                if column_index in used_columns:
+                    continue
+                header_score = get_header_score(key, header)
+                if header_score == 0:
+                    continue
+                score = header_score * (
+                    0.5 + 0.5 * get_value_score(key, column_values[column_index])
+                )
+                if score > scores[key]:
+                    scores[key] = score
+                    response[key] = str(header).strip()
+                    best_column_index = column_index
+            if best_column_index is not None:
+                used_columns.add(best_column_index)
+
+        # A single matching word is not enough to call a row the header row
+        if len([score for score in scores.values() if score > 0]) < 2:
+            continue
+        confidence = sum(scores.values()) / len(HEADER_KEYS)
+        if confidence > best_confidence:
+            best_response = response
+            best_confidence = confidence
+    return best_response, best_confidence
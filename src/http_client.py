@@ -0,0 +1,95 @@
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_POOL_SIZE = 10
+# Keep-alive connections kept per host, sized for the parallel workers talking to it
+POOL_SIZES = {
+    "https://graph.microsoft.com/": 20,
+    "https://api.pricerunner.com/": 4,
+}
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+BACKOFF_JITTER = 0.5
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+
+SESSION: requests.Session = None
+SESSION_LOCK = threading.Lock()
+
+
+class JitteredRetry(Retry):
+
+    def get_backoff_time(self):
+        backoff_time = super().get_backoff_time()
+        if backoff_time <= 0:
+            return backoff_time
+        # Spreads out the retries of parallel workers that were throttled together
+        return backoff_time + random.uniform(0, BACKOFF_JITTER)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = DEFAULT_TIMEOUT
+        return super().send(request, **kwargs)
+
+
+def create_retry():
+    # Retry-After is honoured for 429 and 503 responses before falling back to the backoff
+    return JitteredRetry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRYABLE_STATUS_CODES,
+        # Graph $batch is a POST that only wraps read requests, so it is safe to resend
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        # The last response is returned so callers can read the error body
+        raise_on_status=False,
+    )
+
+
+def create_session(pool_sizes: dict[str, int] = None):
+    if pool_sizes is None:
+        pool_sizes = POOL_SIZES
+
+    session = requests.Session()
+    default_adapter = TimeoutHTTPAdapter(
+        pool_connections=DEFAULT_POOL_SIZE,
+        pool_maxsize=DEFAULT_POOL_SIZE,
+        max_retries=create_retry(),
+    )
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+    for prefix, pool_size in pool_sizes.items():
+        session.mount(
+            prefix,
+            TimeoutHTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                max_retries=create_retry(),
+            ),
+        )
+    return session
+
+
+def get_session():
+    global SESSION
+    if SESSION is None:
+        with SESSION_LOCK:
+            if SESSION is None:
+                SESSION = create_session()
+    return SESSION
+
+
+def get(url: str, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def post(url: str, **kwargs):
+    return get_session().post(url, **kwargs)
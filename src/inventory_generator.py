@@ -1,747 +1,1176 @@
-import csv
+import hashlib
 import io
-import json
-import os.path
+import itertools
+import multiprocessing
+import os
 import statistics
-from typing import List
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Iterable, List, Union
 
+import numpy as np
 import pandas as pd
-import openpyxl
 from omegaconf import DictConfig
 from openai import OpenAI
-from openai.types.beta import Thread, Assistant
 
+from src.analysis_cache import (
+    get_analysis_key,
+    get_analysis_path,
+    load_analysis,
+    save_analysis,
+)
+from src.header_analyser import (
+    ChatHeaderAnalyser,
+    AssistantHeaderAnalyser,
+    BatchHeaderAnalyser,
+    MultiSheetHeaderAnalyser,
+    HEADER_ANALYSIS_MODEL,
+)
+from src.header_cache import HeaderCache, get_fingerprint, FINGERPRINT_ROWS
+from src.header_detector import detect_headers_locally, SAMPLE_ROWS, SAMPLE_VALUES
+from src.models.attachment import Attachment
 from src.models.message import Message
 from src.models.consolidated_sheet import ConsolidatedSheetItem
 from src.models.report_sheet_item import ReportSheetItem
 from src.models.separate_sheet_metadata import SeparateSheetMetadata
-from src.price_generator import get_price_results
-from src.report_generator import generate_report
+from src.models.sheet_analysis import SheetAnalysis
+from src.pipeline import Pipeline
+from src.price_generator import fetch_prices, PRICE_RUNNER_BATCH_SIZE
+from src.prompt_builder import build_prompt, restore_headers
+from src.report_generator import generate_report, ReportWriter
+from src.sheet_classifier import get_skip_reason
+from src.workbook_reader import (
+    WORKBOOK_ERRORS,
+    read_sheets,
+    stream_sheets,
+    get_cell_text,
+    pad_rows,
+    write_csv,
+)
 
-client: OpenAI = None
+header_analyser: Union[
+    ChatHeaderAnalyser,
+    MultiSheetHeaderAnalyser,
+    AssistantHeaderAnalyser,
+    BatchHeaderAnalyser,
+] = None
+header_cache: HeaderCache = None
+# Local header detection is skipped when this is None
+header_detector_confidence: float = None
+sheet_classifier: bool = False
+# Sheets are sent to the header analysis as they are when this is None
+header_prompt_tokens: int = None
+# Each workbook stays with the worker that parsed it, so a worker has its own pool
+process_workers: List[ProcessPoolExecutor] = None
+worker_counter = itertools.count()
+# Workbooks parsed in a worker process, kept there until their rows are extracted
+worker_workbooks: dict[str, List[List[list]]] = {}
+
+HEADER_KEYS = ["barcode", "quantity", "product", "price"]
+# Rows sent to the header analysis, retried with more rows if no headers were found
+HEADER_ANALYSIS_ROWS = [30, 50]
+# Rows read from the top of a streamed sheet, enough for any of the header detections
+HEADER_DETECTION_ROWS = max(
+    FINGERPRINT_ROWS, SAMPLE_ROWS + SAMPLE_VALUES, *HEADER_ANALYSIS_ROWS
+)
 
 
 def generate_inventory(
     output_directory: str,
-    messages: List[Message],
+    messages: Iterable[Message],
     system_logger: "loguru.system_logger",
     config: DictConfig,
 ):
-    global client
-    client = OpenAI(api_key=config.secrets.openai_api_key)
-    assistant = initiate_assistant()
-    thread = None
+    global header_analyser, header_cache, header_detector_confidence, sheet_classifier
+    global header_prompt_tokens, process_workers
+    header_analyser = create_header_analyser(config)
+    header_cache = None
+    if config.app_config.get("header_cache", True):
+        header_cache = HeaderCache(
+            max_entries=config.app_config.get("header_cache_size", 1000),
+            ttl_days=config.app_config.get("header_cache_ttl_days", 90),
+        )
+    header_detector_confidence = None
+    if config.app_config.get("header_detector", True):
+        header_detector_confidence = config.app_config.get(
+            "header_detector_confidence", 0.7
+        )
+    sheet_classifier = config.app_config.get("sheet_classifier", True)
+    header_prompt_tokens = None
+    if config.app_config.get("header_analysis_compact_prompt", True):
+        header_prompt_tokens = config.app_config.get(
+            "header_analysis_prompt_tokens", 2000
+        )
+    # Streamed sheets are read in chunks as they're analysed, so they aren't parsed ahead of time
+    streaming = config.app_config.get("streaming", False)
+    process_workers = None if streaming else create_process_workers(config)
 
     report_sheet_items: List[ReportSheetItem] = []
     separate_sheets: List[SeparateSheetMetadata] = []
     consolidated_sheet_items = []
-
+    report_writer: ReportWriter = None
     message_counter = 0
-    total_messages = len(messages)
-    for message in messages:
-        message_counter += 1
-        print(f"⏳ Analysing {message_counter}/{total_messages} messages")
+    try:
+        if isinstance(header_analyser, BatchHeaderAnalyser):
+            # Backfills favour throughput, so the sheets of the whole run are analysed in one batch
+            messages = list(messages)
+            submit_header_analysis_batches(
+                read_head_sheets(messages, config, system_logger)
+            )
 
-        attachment_counter = 0
-        for attachment in message.attachments:
+        # Messages are analysed while later ones are still downloading, and items are priced as soon as they're extracted
+        pipeline = Pipeline(config.app_config.get("pipeline_queue_size", 10))
+        message_queue = pipeline.add_source(messages)
+        total_messages = len(messages) if isinstance(messages, list) else None
+
+        def parse_message_stage(message: Message, emit):
+            # Workbooks are parsed in the process pool while earlier messages are analysed
+            emit((message, parse_attachments(message, config)))
+
+        parsed_message_queue = pipeline.add_stage(message_queue, parse_message_stage)
+
+        def analyse_message_stage(parsed_message: tuple, emit):
+            nonlocal message_counter, report_writer
+            message, parsed_workbooks = parsed_message
+            message_counter += 1
+            if streaming and report_writer is None:
+                report_writer = ReportWriter(output_directory)
+            if total_messages is None:
+                print(f"⏳ Analysing message {message_counter}")
+            else:
+                print(f"⏳ Analysing {message_counter}/{total_messages} messages")
+
+            number_of_items = len(consolidated_sheet_items)
+            analyse_message(
+                message,
+                message_counter,
+                report_sheet_items,
+                separate_sheets,
+                consolidated_sheet_items,
+                system_logger,
+                config,
+                parsed_workbooks,
+                report_writer,
+                emit,
+            )
+            for item in consolidated_sheet_items[number_of_items:]:
+                emit(item)
+
+        item_queue = pipeline.add_stage(parsed_message_queue, analyse_message_stage)
 
-            # Currently supported attachments: .xls or .xlsx
-            if attachment.name.endswith(".xlsx") or attachment.name.endswith(".xls"):
-                attachment_counter += 1
-                sheets = {}
-                attachment_path = os.path.join(
-                    output_directory,
-                    "Messages",
-                    f"Message {message_counter}",
-                    "Attachments",
-                    attachment.name,
+        # PriceRunner
+        price_runner_items: List[ConsolidatedSheetItem] = []
+
+        def fetch_prices_stage(item: ConsolidatedSheetItem, emit):
+            price_runner_items.append(item)
+            if len(price_runner_items) == PRICE_RUNNER_BATCH_SIZE:
+                fetch_price_runner_items()
+
+        def fetch_price_runner_items(emit=None):
+            if len(price_runner_items) > 0:
+                fetch_prices(
+                    list(price_runner_items),
+                    str(config.secrets.price_runner_token),
+                    system_logger,
                 )
-                try:
-                    try:
-                        workbook = openpyxl.load_workbook(
-                            attachment_path, data_only=True
-                        )
-                    except Exception as ex:
-                        if str(ex).startswith(
-                            "openpyxl does not support the old .xls file format"
-                        ):
-                            xls = pd.ExcelFile(attachment_path, engine="xlrd")
-                            with pd.ExcelWriter(
-                                os.path.join("temp", "temp.xlsx"), engine="openpyxl"
-                            ) as writer:
-                                for xls_sheet_name in xls.sheet_names:
-                                    df = pd.read_excel(
-                                        xls, sheet_name=xls_sheet_name, engine="xlrd"
-                                    )
-                                    df.to_excel(
-                                        writer, sheet_name=xls_sheet_name, index=False
-                                    )
-                            attachment_path = os.path.join("temp", "temp.xlsx")
-                            workbook = openpyxl.load_workbook(
-                                attachment_path, data_only=True
-                            )
-                        else:
-                            raise
-
-                    # Try removing hidden rows from all the sheets
-                    try:
-                        for sheet_name in workbook.sheetnames:
-                            sheet = workbook[sheet_name]
-                            hidden_rows = []
-                            for row in sheet.row_dimensions:
-                                if sheet.row_dimensions[row].hidden:
-                                    hidden_rows.append(row - 1)
-                            df = pd.read_excel(
-                                attachment_path,
-                                sheet_name=sheet.title,
-                                engine="openpyxl",
-                                header=None,
-                            )
-                            sheets[sheet_name] = df.drop(hidden_rows, axis=0)
-                    except:
-                        pass
-
-                    if os.path.exists(os.path.join("temp", "temp.xlsx")):
-                        os.remove(os.path.join("temp", "temp.xlsx"))
-
-                    sheet_counter = 0
-                    for sheet_name, df in sheets.items():
-                        csv_output = io.StringIO()
-                        df.to_csv(csv_output, index=False)
-                        csv_string = csv_output.getvalue()
-                        if csv_string.strip():
-                            csv_string_io = io.StringIO(csv_string)
-                            csv_reader = csv.reader(
-                                csv_string_io, delimiter=",", quotechar='"'
-                            )
-
-                            sheet_counter += 1
-                            separate_sheet_metadata: SeparateSheetMetadata = (
-                                SeparateSheetMetadata()
-                            )
-                            separate_sheet_metadata.name = f"M-{message_counter}A-{attachment_counter}S-{sheet_counter}"
-                            report_sheet_item: ReportSheetItem = ReportSheetItem(
-                                sender=message.sender.name
-                                + " - "
-                                + message.sender.address,
-                                received_at=message.received_at,
-                                sheet_name=separate_sheet_metadata.name,
-                                status="",
-                                comments="",
-                                file_name=attachment.name,
-                                file_path=f"{os.path.join(output_directory, 'Messages', 'Message ' + str(message_counter), 'Attachments', attachment.name)}",
-                            )
-                            separate_sheet = []
-                            table_matrix_indices = {"left": -1, "top": -1, "right": -1}
-                            header_column_index = {
-                                "barcode": -1,
-                                "quantity": -1,
-                                "product": -1,
-                                "price": -1,
-                            }
-
-                            # GPT header analysis
-                            # First 30 rows
-                            thread, analysis = analyse(
-                                df.head(30).to_csv(index=False), thread, assistant
-                            )
-                            if analysis.status == "completed":
-                                response_messages = client.beta.threads.messages.list(
-                                    thread_id=thread.id
-                                )
-                                # Sample
-                                # response = {"barcode": "EAN", "quantity": "", "product": "PRODUCTS", "price": "PRICE €"}
-                                try:
-                                    response = json.loads(
-                                        str(
-                                            response_messages.data[0]
-                                            .content[0]
-                                            .text.value
-                                        )
-                                        .strip()
-                                        .strip("```json")
-                                        .strip()
-                                    )
-                                except:
-                                    response = None
-
-                                # No required headers detected
-                                if response is None or (
-                                    response["barcode"].strip() == ""
-                                    and response["quantity"].strip() == ""
-                                    and response["product"].strip() == ""
-                                    and response["price"].strip() == ""
-                                ):
-                                    # First 50 rows
-                                    thread, analysis = analyse(
-                                        df.head(50).to_csv(index=False),
-                                        thread,
-                                        assistant,
-                                    )
-                                    if analysis.status == "completed":
-                                        response_messages = (
-                                            client.beta.threads.messages.list(
-                                                thread_id=thread.id
-                                            )
-                                        )
-                                        response = json.loads(
-                                            str(
-                                                response_messages.data[0]
-                                                .content[0]
-                                                .text.value
-                                            )
-                                            .strip()
-                                            .strip("```json")
-                                            .strip()
-                                        )
-
-                                # At least one required header detected
-                                if (
-                                    response["barcode"].strip() != ""
-                                    or response["quantity"].strip() != ""
-                                    or response["product"].strip() != ""
-                                    or response["price"].strip() != ""
-                                ):
-                                    header_row_found = False
-
-                                    for row_index, row in enumerate(csv_reader):
-                                        columns = [
-                                            str(col).strip()
-                                            for col_idx, col in enumerate(row)
-                                        ]
-
-                                        if not header_row_found:
-
-                                            # If any column matches with the required header value, reset the results obtained from previous rows
-                                            if (
-                                                (
-                                                    response["barcode"].strip() != ""
-                                                    and response["barcode"].strip()
-                                                    in columns
-                                                )
-                                                or (
-                                                    response["quantity"].strip() != ""
-                                                    and response["quantity"].strip()
-                                                    in columns
-                                                )
-                                                or (
-                                                    response["product"].strip() != ""
-                                                    and response["product"].strip()
-                                                    in columns
-                                                )
-                                                or (
-                                                    response["price"].strip() != ""
-                                                    and response["price"].strip()
-                                                    in columns
-                                                )
-                                            ):
-                                                header_column_index = {
-                                                    "barcode": -1,
-                                                    "quantity": -1,
-                                                    "product": -1,
-                                                    "price": -1,
-                                                }
-
-                                            if (
-                                                response["barcode"].strip() != ""
-                                                and response["barcode"].strip()
-                                                in columns
-                                            ):
-                                                header_column_index["barcode"] = (
-                                                    columns.index(
-                                                        response["barcode"].strip()
-                                                    )
-                                                )
-                                            if (
-                                                response["quantity"].strip() != ""
-                                                and response["quantity"].strip()
-                                                in columns
-                                            ):
-                                                header_column_index["quantity"] = (
-                                                    columns.index(
-                                                        response["quantity"].strip()
-                                                    )
-                                                )
-                                            if (
-                                                response["product"].strip() != ""
-                                                and response["product"].strip()
-                                                in columns
-                                            ):
-                                                header_column_index["product"] = (
-                                                    columns.index(
-                                                        response["product"].strip()
-                                                    )
-                                                )
-                                            if (
-                                                response["price"].strip() != ""
-                                                and response["price"].strip() in columns
-                                            ):
-                                                header_column_index["price"] = (
-                                                    columns.index(
-                                                        response["price"].strip()
-                                                    )
-                                                )
-
-                                            # Required number of headers to detect a header row: 4, OK to also have: >50% (2 or more)
-                                            existence_count = len(
-                                                [
-                                                    index
-                                                    for index in header_column_index.values()
-                                                    if index != -1
-                                                ]
-                                            )
-                                            if existence_count >= 2:
-                                                header_row_found = True
-
-                                                # For separate sheet
-                                                table_matrix_indices["top"] = row_index
-                                                calculate_table_matrix_indices(
-                                                    table_matrix_indices,
-                                                    [
-                                                        row_enum
-                                                        for row_enum_index, row_enum in enumerate(
-                                                            csv.reader(
-                                                                io.StringIO(csv_string),
-                                                                delimiter=",",
-                                                                quotechar='"',
-                                                            )
-                                                        )
-                                                    ],
-                                                    header_column_index,
-                                                )
-                                                result_columns = []
-                                                for column in columns[
-                                                    table_matrix_indices[
-                                                        "left"
-                                                    ] : table_matrix_indices["right"]
-                                                    + 1
-                                                ]:
-                                                    if (
-                                                        str(column)
-                                                        .strip()
-                                                        .startswith("Unnamed:")
-                                                    ):
-                                                        result_columns.append("")
-                                                    else:
-                                                        result_columns.append(column)
-                                                separate_sheet.append(result_columns)
-                                        else:
-                                            # For consolidated sheet
-                                            consolidated_sheet_item: (
-                                                ConsolidatedSheetItem
-                                            ) = ConsolidatedSheetItem(
-                                                sender=message.sender.name
-                                                + " - "
-                                                + message.sender.address,
-                                                barcode="",
-                                                quantity="",
-                                                product_description="",
-                                                unit_price="",
-                                            )
-                                            if header_column_index["barcode"] != -1:
-                                                try:
-                                                    consolidated_sheet_item.barcode = (
-                                                        str(
-                                                            columns[
-                                                                header_column_index[
-                                                                    "barcode"
-                                                                ]
-                                                            ]
-                                                        ).strip()
-                                                    )
-                                                    try:
-                                                        consolidated_sheet_item.barcode = int(
-                                                            float(
-                                                                consolidated_sheet_item.barcode
-                                                            )
-                                                        )
-                                                    except:
-                                                        pass
-                                                except:
-                                                    # May indicate a noisy row
-                                                    pass
-                                            if header_column_index["quantity"] != -1:
-                                                try:
-                                                    consolidated_sheet_item.quantity = (
-                                                        str(
-                                                            columns[
-                                                                header_column_index[
-                                                                    "quantity"
-                                                                ]
-                                                            ]
-                                                        ).strip()
-                                                    )
-                                                    try:
-                                                        consolidated_sheet_item.quantity = int(
-                                                            float(
-                                                                consolidated_sheet_item.quantity
-                                                            )
-                                                        )
-                                                    except:
-                                                        pass
-                                                except:
-                                                    # May indicate a noisy row
-                                                    pass
-                                            if header_column_index["product"] != -1:
-                                                try:
-                                                    consolidated_sheet_item.product_description = str(
-                                                        columns[
-                                                            header_column_index[
-                                                                "product"
-                                                            ]
-                                                        ]
-                                                    ).strip()
-                                                except:
-                                                    # May indicate a noisy row
-                                                    pass
-                                            if header_column_index["price"] != -1:
-                                                try:
-                                                    consolidated_sheet_item.unit_price = str(
-                                                        columns[
-                                                            header_column_index["price"]
-                                                        ]
-                                                    ).strip()
-                                                    try:
-                                                        consolidated_sheet_item.unit_price = float(
-                                                            consolidated_sheet_item.unit_price
-                                                        )
-                                                    except:
-                                                        pass
-                                                except:
-                                                    # May indicate a noisy row
-                                                    pass
-
-                                            # If lesser than 50%, it's noisy
-                                            valid_threshold = 2
-                                            valid_counter = 0
-                                            if str(
-                                                consolidated_sheet_item.barcode
-                                            ).strip():
-                                                valid_counter += 1
-                                                if (
-                                                    str(consolidated_sheet_item.barcode)
-                                                    .strip()
-                                                    .startswith("Unnamed:")
-                                                ):
-                                                    consolidated_sheet_item.barcode = ""
-                                            if str(
-                                                consolidated_sheet_item.quantity
-                                            ).strip():
-                                                valid_counter += 1
-                                                if (
-                                                    str(
-                                                        consolidated_sheet_item.quantity
-                                                    )
-                                                    .strip()
-                                                    .startswith("Unnamed:")
-                                                ):
-                                                    consolidated_sheet_item.quantity = (
-                                                        ""
-                                                    )
-                                            if str(
-                                                consolidated_sheet_item.product_description
-                                            ).strip():
-                                                valid_counter += 1
-                                                if (
-                                                    str(
-                                                        consolidated_sheet_item.product_description
-                                                    )
-                                                    .strip()
-                                                    .startswith("Unnamed:")
-                                                ):
-                                                    consolidated_sheet_item.product_description = (
-                                                        ""
-                                                    )
-                                            if str(
-                                                consolidated_sheet_item.unit_price
-                                            ).strip():
-                                                valid_counter += 1
-                                                if (
-                                                    str(
-                                                        consolidated_sheet_item.unit_price
-                                                    )
-                                                    .strip()
-                                                    .startswith("Unnamed:")
-                                                ):
-                                                    consolidated_sheet_item.unit_price = (
-                                                        ""
-                                                    )
-
-                                            if valid_counter >= valid_threshold:
-                                                consolidated_sheet_items.append(
-                                                    consolidated_sheet_item
-                                                )
-
-                                            # For separate sheet
-                                            try:
-                                                required_columns = columns[
-                                                    table_matrix_indices[
-                                                        "left"
-                                                    ] : table_matrix_indices["right"]
-                                                    + 1
-                                                ]
-
-                                                # Checking index of column with real value despite knowing matrix to avoid noisy row
-                                                lindex = 0
-                                                rindex = 0
-                                                for column_index in range(
-                                                    len(required_columns)
-                                                ):
-                                                    if (
-                                                        required_columns[column_index]
-                                                        is not None
-                                                        and str(
-                                                            required_columns[
-                                                                column_index
-                                                            ]
-                                                        ).strip()
-                                                    ):
-                                                        lindex = column_index
-                                                        break
-                                                for column_index in range(
-                                                    len(required_columns) - 1, -1, -1
-                                                ):
-                                                    if (
-                                                        required_columns[column_index]
-                                                        is not None
-                                                        and str(
-                                                            required_columns[
-                                                                column_index
-                                                            ]
-                                                        ).strip()
-                                                    ):
-                                                        rindex = column_index
-                                                        break
-
-                                                # If lesser than 50%, it's noisy
-                                                if ((rindex + 1) - lindex) >= (
-                                                    (table_matrix_indices["right"] + 1)
-                                                    - table_matrix_indices["left"]
-                                                ) / 2:
-                                                    result_columns = []
-                                                    for (
-                                                        required_column
-                                                    ) in required_columns:
-                                                        if (
-                                                            str(required_column)
-                                                            .strip()
-                                                            .startswith("Unnamed:")
-                                                        ):
-                                                            result_columns.append("")
-                                                        else:
-                                                            for column_index in range(
-                                                                len(columns)
-                                                            ):
-                                                                if (
-                                                                    str(
-                                                                        columns[
-                                                                            column_index
-                                                                        ]
-                                                                    ).strip()
-                                                                    == str(
-                                                                        required_column
-                                                                    ).strip()
-                                                                ):
-                                                                    if (
-                                                                        column_index
-                                                                        == header_column_index[
-                                                                            "barcode"
-                                                                        ]
-                                                                        or column_index
-                                                                        == header_column_index[
-                                                                            "quantity"
-                                                                        ]
-                                                                    ):
-                                                                        try:
-                                                                            result_columns.append(
-                                                                                int(
-                                                                                    float(
-                                                                                        str(
-                                                                                            required_column
-                                                                                        ).strip()
-                                                                                    )
-                                                                                )
-                                                                            )
-                                                                        except:
-                                                                            result_columns.append(
-                                                                                required_column
-                                                                            )
-                                                                    elif (
-                                                                        column_index
-                                                                        == header_column_index[
-                                                                            "quantity"
-                                                                        ]
-                                                                    ):
-                                                                        try:
-                                                                            result_columns.append(
-                                                                                float(
-                                                                                    str(
-                                                                                        required_column
-                                                                                    ).strip()
-                                                                                )
-                                                                            )
-                                                                        except:
-                                                                            result_columns.append(
-                                                                                required_column
-                                                                            )
-                                                                    else:
-                                                                        result_columns.append(
-                                                                            required_column
-                                                                        )
-                                                                    break
-                                                    separate_sheet.append(
-                                                        result_columns
-                                                    )
-                                            except:
-                                                # May indicate a noisy row
-                                                pass
-
-                                # Check if separate sheet has rows (including the header row)
-                                if len(separate_sheet) > 1:
-                                    separate_sheet_metadata.sheet = separate_sheet
-                                    separate_sheets.append(separate_sheet_metadata)
-                                # If not, remove the sheet name so that it doesn't appear in summary
-                                else:
-                                    separate_sheet_metadata.name = ""
-
-                                # Update summary based on GPT analysis result
-                                existence_count = len(
-                                    [
-                                        index
-                                        for index in header_column_index.values()
-                                        if index != -1
-                                    ]
-                                )
-                                if existence_count == 4:
-                                    report_sheet_item.status = "PROCESSED"
-                                elif existence_count >= 2:
-                                    report_sheet_item.status = "PARTIALLY PROCESSED"
-                                    report_sheet_item.comments = (
-                                        "Couldn't detect any headers that relate to"
-                                    )
-                                    if header_column_index["barcode"] == -1:
-                                        report_sheet_item.comments += " barcode,"
-                                    if header_column_index["quantity"] == -1:
-                                        report_sheet_item.comments += " quantity,"
-                                    if header_column_index["product"] == -1:
-                                        report_sheet_item.comments += (
-                                            " product description,"
-                                        )
-                                    if header_column_index["price"] == -1:
-                                        report_sheet_item.comments += " unit price,"
-                                    report_sheet_item.comments = (
-                                        report_sheet_item.comments[
-                                            0 : len(report_sheet_item.comments) - 1
-                                        ]
-                                    )
-                                else:
-                                    report_sheet_item.status = "NOT PROCESSED"
-                                    if existence_count == 1:
-                                        report_sheet_item.comments = "Could detect just one header that relate to barcode, quantity, product description or unit price."
-                                    else:
-                                        report_sheet_item.comments = "Couldn't detect any headers that relate to barcode, quantity, product description, unit price."
-                                    report_sheet_item[2] = ""
-                                report_sheet_items.append(report_sheet_item)
-                except Exception as ex:
-                    system_logger.info(
-                        "\nException occurred while processing the mail from:\nSender: "
-                        + message.sender.name
-                        + " - "
-                        + message.sender.address
-                        + "\n"
-                        + "Received at: "
-                        + str(message.received_at)
-                        + "\n"
-                        + "Attachment failed to process: "
-                        + attachment.name
-                        + "\n"
-                    )
-                    system_logger.exception(ex)
-                    report_sheet_items.append(
-                        ReportSheetItem(
-                            sender=message.sender.name + " - " + message.sender.address,
-                            received_at=message.received_at,
-                            sheet_name="",
-                            status="NOT PROCESSED",
-                            comments="System Exception: Couldn't process the attachment. Check logs for more details.",
-                            file_name=attachment.name,
-                            file_path=f"{os.path.join(output_directory, 'Messages', 'Message ' + str(message_counter), 'Attachments', attachment.name)}",
-                        )
-                    )
+                # Streamed items are written as soon as they're priced instead of being kept for the report
+                if report_writer is not None:
+                    report_writer.append_consolidated_items(price_runner_items)
+                price_runner_items.clear()
 
-    # PriceRunner
-    get_price_results(consolidated_sheet_items, config, system_logger)
+        print("⏳ Fetching PriceRunner details")
+        pipeline.add_stage(
+            item_queue, fetch_prices_stage, fetch_price_runner_items, has_output=False
+        )
+        pipeline.join()
+    finally:
+        if header_cache is not None:
+            header_cache.save()
+            system_logger.info(header_cache.get_stats())
+        if process_workers is not None:
+            for process_worker in process_workers:
+                process_worker.shutdown(cancel_futures=True)
+            process_workers = None
 
     # Generate report
-    generate_report(
-        output_directory, separate_sheets, consolidated_sheet_items, report_sheet_items
+    if report_writer is not None:
+        report_writer.save(report_sheet_items)
+    elif message_counter > 0:
+        generate_report(
+            output_directory,
+            separate_sheets,
+            consolidated_sheet_items,
+            report_sheet_items,
+        )
+
+
+def create_process_workers(config: DictConfig):
+    # Parsing workbooks and extracting their rows is CPU bound, so it runs in separate processes.
+    # Even with a single CPU, a workbook is parsed while the previous one waits for its headers
+    parse_workers = config.app_config.get("parse_workers", max(os.cpu_count() or 1, 2))
+    if parse_workers <= 1:
+        return None
+    return [
+        ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+        for _ in range(parse_workers)
+    ]
+
+
+def parse_attachments(message: Message, config: DictConfig):
+    parsed_workbooks: dict[int, ParsedWorkbook] = {}
+    if process_workers is None:
+        return parsed_workbooks
+
+    for attachment_index, attachment in enumerate(message.attachments):
+        if attachment.is_excel_file:
+            # Attachments with a saved analysis don't need to be parsed
+            if has_saved_analysis(attachment, config):
+                continue
+            process_worker = process_workers[
+                next(worker_counter) % len(process_workers)
+            ]
+            workbook_id = uuid.uuid4().hex
+            parsed_workbooks[attachment_index] = ParsedWorkbook(
+                process_worker.submit(
+                    parse_workbook,
+                    workbook_id,
+                    attachment.content if attachment.is_in_memory else attachment.path,
+                ),
+                process_worker,
+                workbook_id,
+            )
+    return parsed_workbooks
+
+
+# A workbook parsed ahead of its analysis, either in this process or in a worker process
+class ParsedWorkbook:
+
+    def __init__(
+        self,
+        sheets: Future,
+        process_worker: ProcessPoolExecutor = None,
+        workbook_id: str = None,
+    ):
+        # Rows of the non-empty sheets. A worker only sends back the top of each sheet
+        self.sheets = sheets
+        self.process_worker = process_worker
+        self.workbook_id = workbook_id
+
+    def extract(self, responses: List[dict], sheet_analyses: List[SheetAnalysis]):
+        if self.process_worker is None:
+            return extract_sheets(self.sheets.result(), responses, sheet_analyses)
+        # Only the headers are sent to the worker, which extracts the rows it kept and drops them
+        process_worker = self.process_worker
+        self.process_worker = None
+        return process_worker.submit(
+            extract_workbook, self.workbook_id, responses, sheet_analyses
+        ).result()
+
+    # Workbooks that weren't extracted, such as those with a saved analysis, are dropped from their worker
+    def release(self):
+        if self.process_worker is not None and self.sheets.exception() is None:
+            self.process_worker.submit(release_workbook, self.workbook_id)
+            self.process_worker = None
+
+
+def read_workbook(attachment_file: Union[str, BinaryIO]):
+    sheets = Future()
+    try:
+        sheets.set_result(
+            [rows for rows in read_sheets(attachment_file).values() if len(rows) > 0]
+        )
+    except Exception as ex:
+        # Raised when the sheets are used
+        sheets.set_exception(ex)
+    return ParsedWorkbook(sheets)
+
+
+# Runs in a worker process
+def parse_workbook(workbook_id: str, attachment_file: Union[str, bytes]):
+    sheets = [rows for rows in read_sheets(attachment_file).values() if len(rows) > 0]
+    worker_workbooks[workbook_id] = sheets
+    # The top of each sheet is all the header analysis needs
+    return [rows[:HEADER_DETECTION_ROWS] for rows in sheets]
+
+
+# Runs in a worker process
+def extract_workbook(
+    workbook_id: str, responses: List[dict], sheet_analyses: List[SheetAnalysis]
+):
+    return extract_sheets(worker_workbooks.pop(workbook_id), responses, sheet_analyses)
+
+
+# Runs in a worker process
+def release_workbook(workbook_id: str):
+    worker_workbooks.pop(workbook_id, None)
+
+
+def has_saved_analysis(attachment: Attachment, config: DictConfig):
+    return config.app_config.get("analysis_cache", True) and os.path.exists(
+        get_analysis_path(get_attachment_analysis_key(attachment, config))
     )
 
 
-def initiate_assistant():
-    assistant = client.beta.assistants.create(
-        name="Sales Data Analyser",
-        instructions='You are a sales data assistant who identifies the header row (i.e., The CSV line) and provides four headers from a CSV (Comma Separated Values) file content in the JSON dict format: {"barcode": <Barcode_Column>, "quantity": <Quantity_Column>, "product": <Product_Column>, "price": <Price_Column>}. Each property relates to Barcode, Quantity, Product description and Price column headers respectively in the CSV file. The synonym of the header\'s words, or sometimes abbreviations, should match the requirement. For example, the header for Barcode (a GTIN) could be EAN, UPC, GTIN, etc. The header for Quantity could be Quantity, Stock, Pieces, PCS, QTY, Units, etc. The header for Price could be Price, Unit Price, Cost, etc. The header for Product could be Product, Name, Description, Item, DESC, etc. The result values should strictly be from the same row which is considered as header row and not different rows. You could also look the the column\'s values to verify if most of them relate to what you decide the column\'s header is. For example, you can verify the column header for Barcode by not only looking at the header\'s words, but also if most of that column\'s values has valid barcodes (GTIN). If you could not find a suitable value for a property, set an empty string to that.',
-        # model="ft:gpt-3.5-turbo-0125:vallabha-systems-limited:header-prediction:9lFHETSg"
-        # Latest
-        model="ft:gpt-3.5-turbo-0125:vallabha-systems-limited:header-prediction:9nk6uHeF",
+def get_attachment_analysis_key(attachment: Attachment, config: DictConfig):
+    return get_analysis_key(get_content_hash(attachment), get_analysis_settings(config))
+
+
+# Settings that change the analysis of a workbook
+def get_analysis_settings(config: DictConfig):
+    return {
+        "header_detector_confidence": header_detector_confidence,
+        "sheet_classifier": sheet_classifier,
+        "header_prompt_tokens": header_prompt_tokens,
+        "header_analysis_rows": HEADER_ANALYSIS_ROWS,
+        "header_analysis_backend": config.app_config.get(
+            "header_analysis_backend", "chat"
+        ),
+        "header_analysis_model": config.app_config.get(
+            "header_analysis_model", HEADER_ANALYSIS_MODEL
+        ),
+        "header_analysis_json_schema": config.app_config.get(
+            "header_analysis_json_schema", False
+        ),
+        "header_analysis_multi_sheet": config.app_config.get(
+            "header_analysis_multi_sheet", False
+        ),
+        "header_analysis_multi_sheet_tokens": config.app_config.get(
+            "header_analysis_multi_sheet_tokens", 12000
+        ),
+    }
+
+
+def create_header_analyser(config: DictConfig):
+    client = OpenAI(api_key=config.secrets.openai_api_key)
+    model = config.app_config.get("header_analysis_model", HEADER_ANALYSIS_MODEL)
+    backend = config.app_config.get("header_analysis_backend", "chat")
+    if backend == "assistant":
+        return AssistantHeaderAnalyser(client, model)
+    if backend == "batch":
+        return BatchHeaderAnalyser(
+            client,
+            model,
+            json_schema=config.app_config.get("header_analysis_json_schema", False),
+            poll_seconds=config.app_config.get(
+                "header_analysis_batch_poll_seconds", 60
+            ),
+        )
+    if config.app_config.get("header_analysis_multi_sheet", False):
+        return MultiSheetHeaderAnalyser(
+            client,
+            model,
+            max_concurrency=config.app_config.get("header_analysis_max_concurrency", 4),
+            requests_per_minute=config.app_config.get(
+                "header_analysis_requests_per_minute", 300
+            ),
+            json_schema=config.app_config.get("header_analysis_json_schema", False),
+            max_tokens=config.app_config.get(
+                "header_analysis_multi_sheet_tokens", 12000
+            ),
+        )
+    return ChatHeaderAnalyser(
+        client,
+        model,
+        max_concurrency=config.app_config.get("header_analysis_max_concurrency", 4),
+        requests_per_minute=config.app_config.get(
+            "header_analysis_requests_per_minute", 300
+        ),
+        json_schema=config.app_config.get("header_analysis_json_schema", False),
     )
-    return assistant
 
 
-def initialize_thread():
-    thread = client.beta.threads.create()
-    return thread
+# Prompts are collected again after each submit, for the sheets retried with more rows
+def submit_header_analysis_batches(sheets: List[tuple[str, List[list]]]):
+    while True:
+        for sender, rows in sheets:
+            detect_headers_or_load(rows, SheetAnalysis(), sender)
+        if not header_analyser.has_pending_prompts():
+            break
+        header_analyser.submit()
+
+
+# The top of each sheet that needs the header analysis, with the sender of its message.
+# Only the top is read, so the sheets of a whole run fit in memory
+def read_head_sheets(
+    messages: List[Message],
+    config: DictConfig,
+    system_logger: "loguru.system_logger",
+):
+    streaming = config.app_config.get("streaming", False)
+    sheets = []
+    for message in messages:
+        for attachment in message.attachments:
+            # Streamed attachments are always analysed, without the saved analyses
+            if not attachment.is_excel_file or (
+                not streaming and has_saved_analysis(attachment, config)
+            ):
+                continue
+            try:
+                for _, get_rows in stream_sheets(get_attachment_file(attachment)):
+                    head_rows = read_head_rows(get_rows)
+                    if len(head_rows) > 0:
+                        sheets.append(
+                            (get_header_cache_sender(message, config), head_rows)
+                        )
+            except WORKBOOK_ERRORS:
+                # The attachment is reported as not processed when it's analysed
+                system_logger.exception(
+                    f"Couldn't read the attachment {attachment.name} for the header analysis"
+                )
+    return sheets
+
+
+# Reads the attachments that weren't parsed in a worker process, so they're only read once
+def read_attachments(
+    message: Message, config: DictConfig, parsed_workbooks: dict[int, ParsedWorkbook]
+):
+    parsed_workbooks = dict(parsed_workbooks)
+    for attachment_index, attachment in enumerate(message.attachments):
+        if (
+            attachment.is_excel_file
+            and attachment_index not in parsed_workbooks
+            and not has_saved_analysis(attachment, config)
+        ):
+            parsed_workbooks[attachment_index] = read_workbook(
+                get_attachment_file(attachment)
+            )
+    return parsed_workbooks
+
 
+def get_header_cache_sender(message: Message, config: DictConfig):
+    if config.app_config.get("header_cache_by_sender", False):
+        return message.sender.address
+    return None
 
-def reinitialize_thread(thread: Thread):
-    for message in client.beta.threads.messages.list(thread_id=thread.id):
+
+def analyse_message(
+    message: Message,
+    message_counter: int,
+    report_sheet_items: List[ReportSheetItem],
+    separate_sheets: List[SeparateSheetMetadata],
+    consolidated_sheet_items: List[ConsolidatedSheetItem],
+    system_logger: "loguru.system_logger",
+    config: DictConfig,
+    parsed_workbooks: dict[int, ParsedWorkbook] = None,
+    report_writer: ReportWriter = None,
+    emit_item: Callable[[ConsolidatedSheetItem], None] = None,
+):
+    if isinstance(header_analyser, MultiSheetHeaderAnalyser):
+        if report_writer is None:
+            # The same sheets are used for the header analysis and the extraction
+            parsed_workbooks = read_attachments(message, config, parsed_workbooks or {})
+            sender = get_header_cache_sender(message, config)
+            sheets = [
+                (sender, rows)
+                for parsed_workbook in parsed_workbooks.values()
+                if parsed_workbook.sheets.exception() is None
+                for rows in parsed_workbook.sheets.result()
+            ]
+        else:
+            sheets = read_head_sheets([message], config, system_logger)
+
+        # The sheets of all the attachments are sent together, then with more rows for those without headers
+        header_analyser.start_collecting()
         try:
-            client.beta.threads.messages.delete(
-                thread_id=thread.id, message_id=message.id
+            submit_header_analysis_batches(sheets)
+        finally:
+            header_analyser.stop_collecting()
+
+    parsed_workbooks = parsed_workbooks or {}
+    attachment_counter = 0
+    for attachment_index, attachment in enumerate(message.attachments):
+        if attachment.is_excel_file:
+            attachment_counter += 1
+            parsed_workbook = parsed_workbooks.get(attachment_index)
+            try:
+                if report_writer is not None:
+                    # Sheets go straight to the report and their items to the pricing
+                    stream_attachment(
+                        attachment,
+                        message,
+                        message_counter,
+                        attachment_counter,
+                        report_sheet_items,
+                        report_writer,
+                        emit_item,
+                        config,
+                    )
+                    continue
+
+                sheet_analyses = analyse_attachment_or_load(
+                    attachment,
+                    get_header_cache_sender(message, config),
+                    config,
+                    parsed_workbook,
+                )
+                append_sheet_analyses(
+                    sheet_analyses,
+                    message,
+                    message_counter,
+                    attachment,
+                    attachment_counter,
+                    report_sheet_items,
+                    separate_sheets,
+                    consolidated_sheet_items,
+                )
+            except Exception as ex:
+                system_logger.info(
+                    "\nException occurred while processing the mail from:\nSender: "
+                    + message.sender.name
+                    + " - "
+                    + message.sender.address
+                    + "\n"
+                    + "Received at: "
+                    + str(message.received_at)
+                    + "\n"
+                    + "Attachment failed to process: "
+                    + attachment.name
+                    + "\n"
+                )
+                system_logger.exception(ex)
+                report_sheet_items.append(
+                    ReportSheetItem(
+                        sender=message.sender.name + " - " + message.sender.address,
+                        received_at=message.received_at,
+                        sheet_name="",
+                        status="NOT PROCESSED",
+                        comments="System Exception: Couldn't process the attachment. Check logs for more details.",
+                        file_name=attachment.name,
+                        file_path=attachment.path,
+                    )
+                )
+            finally:
+                if parsed_workbook is not None:
+                    parsed_workbook.release()
+
+
+def get_content_hash(attachment: Attachment):
+    if attachment.content_hash is None:
+        attachment.content_hash = hashlib.sha256(attachment.content).hexdigest()
+    return attachment.content_hash
+
+
+def get_attachment_file(attachment: Attachment):
+    # Attachments still in memory are parsed without reading them back from disk
+    if attachment.is_in_memory:
+        return io.BytesIO(attachment.content)
+    return attachment.path
+
+
+def analyse_attachment_or_load(
+    attachment: Attachment,
+    sender: str,
+    config: DictConfig,
+    parsed_workbook: ParsedWorkbook = None,
+):
+    if not config.app_config.get("analysis_cache", True):
+        return analyse_attachment(
+            get_attachment_file(attachment), sender, parsed_workbook
+        )
+
+    # The same workbook bytes always give the same analysis, so earlier results are replayed
+    analysis_key = get_attachment_analysis_key(attachment, config)
+    sheet_analyses = load_analysis(analysis_key)
+    if sheet_analyses is None:
+        sheet_analyses = analyse_attachment(
+            get_attachment_file(attachment), sender, parsed_workbook
+        )
+        if all(sheet_analysis.completed for sheet_analysis in sheet_analyses):
+            save_analysis(analysis_key, sheet_analyses)
+    return sheet_analyses
+
+
+def append_sheet_analyses(
+    sheet_analyses: List[SheetAnalysis],
+    message: Message,
+    message_counter: int,
+    attachment: Attachment,
+    attachment_counter: int,
+    report_sheet_items: List[ReportSheetItem],
+    separate_sheets: List[SeparateSheetMetadata],
+    consolidated_sheet_items: List[ConsolidatedSheetItem],
+):
+    sender = message.sender.name + " - " + message.sender.address
+    sheet_counter = 0
+    for sheet_analysis in sheet_analyses:
+        sheet_counter += 1
+        separate_sheet_metadata: SeparateSheetMetadata = SeparateSheetMetadata()
+        separate_sheet_metadata.name = (
+            f"M-{message_counter}A-{attachment_counter}S-{sheet_counter}"
+        )
+        consolidated_sheet_items.extend(
+            create_consolidated_sheet_items(sender, sheet_analysis.items)
+        )
+
+        # Check if separate sheet has rows (including the header row)
+        if len(sheet_analysis.separate_sheet) > 1:
+            separate_sheet_metadata.sheet = sheet_analysis.separate_sheet
+            separate_sheets.append(separate_sheet_metadata)
+
+        report_sheet_items.append(
+            create_report_sheet_item(
+                sheet_analysis,
+                separate_sheet_metadata.name,
+                sender,
+                message,
+                attachment,
+            )
+        )
+
+
+def create_consolidated_sheet_items(sender: str, items: List[list]):
+    return [
+        ConsolidatedSheetItem(
+            sender=sender,
+            barcode=barcode,
+            quantity=quantity,
+            product_description=product_description,
+            unit_price=unit_price,
+        )
+        for barcode, quantity, product_description, unit_price in items
+    ]
+
+
+def create_report_sheet_item(
+    sheet_analysis: SheetAnalysis,
+    sheet_name: str,
+    sender: str,
+    message: Message,
+    attachment: Attachment,
+):
+    report_sheet_item: ReportSheetItem = ReportSheetItem(
+        sender=sender,
+        received_at=message.received_at,
+        sheet_name=sheet_name,
+        status=sheet_analysis.status,
+        comments=sheet_analysis.comments,
+        file_name=attachment.name,
+        file_path=attachment.path,
+    )
+    if sheet_analysis.status in ["NOT PROCESSED", "SKIPPED"]:
+        report_sheet_item.sheet_name = ""
+    return report_sheet_item
+
+
+def stream_attachment(
+    attachment: Attachment,
+    message: Message,
+    message_counter: int,
+    attachment_counter: int,
+    report_sheet_items: List[ReportSheetItem],
+    report_writer: ReportWriter,
+    emit_item: Callable[[ConsolidatedSheetItem], None],
+    config: DictConfig,
+):
+    sender = message.sender.name + " - " + message.sender.address
+    chunk_rows = config.app_config.get("streaming_chunk_rows", 10000)
+    sheet_counter = 0
+    for _, get_rows in stream_sheets(get_attachment_file(attachment)):
+        head_rows = read_head_rows(get_rows)
+        if len(head_rows) == 0:
+            continue
+        sheet_counter += 1
+        sheet_name = f"M-{message_counter}A-{attachment_counter}S-{sheet_counter}"
+
+        def add_items(items: List[list]):
+            for item in create_consolidated_sheet_items(sender, items):
+                emit_item(item)
+
+        def add_separate_rows(rows: List[list]):
+            report_writer.append_separate_rows(sheet_name, rows)
+
+        sheet_analysis = SheetAnalysis()
+        response = detect_headers_or_load(
+            head_rows, sheet_analysis, get_header_cache_sender(message, config)
+        )
+        if response is not None:
+            try:
+                stream_rows(
+                    get_rows,
+                    response,
+                    sheet_analysis,
+                    chunk_rows,
+                    add_items,
+                    add_separate_rows,
+                )
+            finally:
+                report_writer.close_separate_sheet(sheet_name)
+        set_status(sheet_analysis)
+        report_sheet_items.append(
+            create_report_sheet_item(
+                sheet_analysis, sheet_name, sender, message, attachment
             )
-        except:
-            pass
-        return client.beta.threads.retrieve(thread_id=thread.id)
+        )
+
 
+def read_head_rows(get_rows: Callable[[], Iterable[list]]):
+    return pad_rows(list(itertools.islice(get_rows(), HEADER_DETECTION_ROWS)))
 
-def analyse(prompt_content: str, thread: Thread, assistant: Assistant):
-    if thread is None:
-        thread = initialize_thread()
+
+def analyse_attachment(
+    attachment_file: Union[str, BinaryIO],
+    sender: str = None,
+    parsed_workbook: ParsedWorkbook = None,
+):
+    if parsed_workbook is None:
+        parsed_workbook = read_workbook(attachment_file)
+    sheets = parsed_workbook.sheets.result()
+
+    # The sheets of a workbook are analysed at the same time, in the order they appear
+    max_workers = header_analyser.max_concurrency if header_analyser else 1
+    if len(sheets) <= 1 or max_workers <= 1:
+        sheet_headers = [detect_sheet_headers(rows, sender) for rows in sheets]
     else:
-        thread = reinitialize_thread(thread)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(sheets))) as executor:
+            sheet_headers = list(
+                executor.map(lambda rows: detect_sheet_headers(rows, sender), sheets)
+            )
+    return parsed_workbook.extract(
+        [response for response, _ in sheet_headers],
+        [sheet_analysis for _, sheet_analysis in sheet_headers],
+    )
+
+
+def detect_sheet_headers(rows: List[list], sender: str = None):
+    sheet_analysis = SheetAnalysis()
+
+    # GPT header analysis
+    response = detect_headers_or_load(rows, sheet_analysis, sender)
+    return response, sheet_analysis
+
+
+def extract_sheets(
+    sheets: List[List[list]],
+    responses: List[dict],
+    sheet_analyses: List[SheetAnalysis],
+):
+    for rows, response, sheet_analysis in zip(sheets, responses, sheet_analyses):
+        if response is not None:
+            extract_rows(rows, response, sheet_analysis)
+        set_status(sheet_analysis)
+    return sheet_analyses
+
+
+def detect_headers_or_load(
+    rows: List[list], sheet_analysis: SheetAnalysis, sender: str = None
+):
+    # Suppliers usually resend the same layout, which maps to the same headers
+    sample_rows = rows[:FINGERPRINT_ROWS]
+    fingerprint = None
+    if header_cache is not None:
+        fingerprint = get_fingerprint(sample_rows, sender)
+        if fingerprint is not None:
+            response = header_cache.get(fingerprint)
+            if response is not None and is_response_in_rows(response, sample_rows):
+                return response
+
+    # Well labelled sheets don't need the assistant
+    if header_detector_confidence is not None:
+        response, confidence = detect_headers_locally(
+            rows[: SAMPLE_ROWS + SAMPLE_VALUES]
+        )
+        if confidence >= header_detector_confidence:
+            return response
+
+    # Cover pages, terms and notes aren't sent to the header analysis
+    if sheet_classifier:
+        skip_reason = get_skip_reason(rows)
+        if skip_reason is not None:
+            sheet_analysis.status = "SKIPPED"
+            sheet_analysis.comments = skip_reason
+            return None
+
+    response = detect_headers(rows, sheet_analysis)
+    if fingerprint is not None and response is not None and sheet_analysis.completed:
+        header_cache.put(fingerprint, response)
+    return response
+
 
-    client.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content="Please provide me the four headers from the header row that relate to Barcode, Product, Quantity and Price in a JSON dict format by analysing the given CSV content:\n"
-        + prompt_content,
+def is_response_in_rows(response: dict, rows: List[list]):
+    cell_texts = set(get_cell_text(value) for row in rows for value in row)
+    return all(
+        response[key].strip() in cell_texts
+        for key in HEADER_KEYS
+        if response[key].strip() != ""
     )
 
-    run = client.beta.threads.runs.create_and_poll(
-        assistant_id=assistant.id, thread_id=thread.id
+
+def detect_headers(rows: List[list], sheet_analysis: SheetAnalysis):
+    # Sample
+    # response = {"barcode": "EAN", "quantity": "", "product": "PRODUCTS", "price": "PRICE €"}
+    response = None
+
+    # First 30 rows, then first 50 rows if no required headers were detected
+    previous_csv_content = None
+    for number_of_rows in HEADER_ANALYSIS_ROWS:
+        original_texts = {}
+        if header_prompt_tokens is None:
+            # Padded to the width of these rows only, so the prompt is the same whether or not the rest of the sheet was read
+            csv_content = write_csv(
+                pad_rows([list(row) for row in rows[:number_of_rows]])
+            )
+        else:
+            csv_content, original_texts = build_prompt(
+                rows, number_of_rows, header_prompt_tokens
+            )
+        # Short sheets would be sent again without any more rows
+        if csv_content == previous_csv_content:
+            break
+        previous_csv_content = csv_content
+
+        completed, response = header_analyser.analyse(csv_content)
+        if not completed:
+            sheet_analysis.completed = False
+            return None
+
+        response = restore_headers(response, original_texts)
+
+        if response is not None and any(
+            response[key].strip() != "" for key in HEADER_KEYS
+        ):
+            return response
+    return response
+
+
+def extract_rows(rows: List[list], response: dict, sheet_analysis: SheetAnalysis):
+    header_column_index = sheet_analysis.header_column_index
+    table_matrix_indices = {"left": -1, "top": -1, "right": -1}
+
+    text_rows = [[get_cell_text(value) for value in row] for row in rows]
+    for row_index, columns in enumerate(text_rows):
+        if match_header_row(columns, response, header_column_index):
+            # The rows below the header are extracted column by column
+            cells = to_cells(text_rows[row_index + 1 :], len(columns))
+
+            # For separate sheet
+            table_matrix_indices["top"] = row_index
+            calculate_table_matrix_indices(
+                table_matrix_indices, cells, header_column_index
+            )
+            sheet_analysis.separate_sheet.append(
+                get_separate_header_row(columns, table_matrix_indices)
+            )
+
+            sheet_analysis.items.extend(extract_items(cells, header_column_index))
+            sheet_analysis.separate_sheet.extend(
+                extract_separate_sheet_rows(
+                    cells, table_matrix_indices, header_column_index
+                )
+            )
+            break
+
+
+# Same as extract_rows, but only a chunk of rows is held at a time. The rows below the header are
+# read twice, first for the bounds of the separate sheet and then to extract them
+def stream_rows(
+    get_rows: Callable[[], Iterable[list]],
+    response: dict,
+    sheet_analysis: SheetAnalysis,
+    chunk_rows: int,
+    add_items: Callable[[List[list]], None],
+    add_separate_rows: Callable[[List[list]], None],
+):
+    header_column_index = sheet_analysis.header_column_index
+    table_matrix_indices = {"left": -1, "top": -1, "right": -1}
+
+    text_rows = ([get_cell_text(value) for value in row] for row in get_rows())
+    # Rows are padded to the width of the whole sheet, like they are when it's read at once
+    width = 0
+    columns = None
+    for row_index, row in enumerate(text_rows):
+        width = max(width, len(row))
+        if match_header_row(row, response, header_column_index):
+            table_matrix_indices["top"] = row_index
+            columns = row
+            break
+    if columns is None:
+        return
+
+    left_counter = ModeCounter()
+    right_counter = ModeCounter()
+    for text_chunk in iter_chunks(text_rows, chunk_rows):
+        cells = to_cells(
+            text_chunk, max(len(columns), max(len(row) for row in text_chunk))
+        )
+        width = max(width, cells.shape[1])
+        left_indices, right_indices = get_row_bounds(cells, header_column_index)
+        left_counter.add(left_indices)
+        right_counter.add(right_indices)
+    table_matrix_indices["left"] = left_counter.get_mode()
+    table_matrix_indices["right"] = right_counter.get_mode()
+
+    # Left out when no rows are kept below it
+    separate_header_row = get_separate_header_row(
+        columns + [""] * (width - len(columns)), table_matrix_indices
+    )
+    text_rows = (
+        [get_cell_text(value) for value in row]
+        for row in itertools.islice(get_rows(), table_matrix_indices["top"] + 1, None)
     )
-    return thread, run
+    for text_chunk in iter_chunks(text_rows, chunk_rows):
+        cells = to_cells(text_chunk, width)
+        add_items(extract_items(cells, header_column_index))
+        separate_rows = extract_separate_sheet_rows(
+            cells, table_matrix_indices, header_column_index
+        )
+        if len(separate_rows) > 0:
+            if separate_header_row is not None:
+                separate_rows.insert(0, separate_header_row)
+                separate_header_row = None
+            add_separate_rows(separate_rows)
 
 
-def calculate_table_matrix_indices(table_matrix_indices, csv_rows, header_column_index):
-    left_indices = []
-    right_indices = []
-    for row_index in range(table_matrix_indices["top"] + 1, len(csv_rows)):
-        columns = [str(col).strip() for col_idx, col in enumerate(csv_rows[row_index])]
+def iter_chunks(items: Iterable, size: int):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
-        for column_index in range(len(columns)):
-            if column_index in header_column_index.values() or (
-                columns[column_index] is not None and str(columns[column_index]).strip()
-            ):
-                left_indices.append(column_index)
-                break
-        for column_index in range(len(columns) - 1, -1, -1):
-            if column_index in header_column_index.values() or (
-                columns[column_index] is not None and str(columns[column_index]).strip()
-            ):
-                right_indices.append(column_index)
-                break
 
-    table_matrix_indices["left"] = statistics.mode(left_indices)
-    table_matrix_indices["right"] = statistics.mode(right_indices)
+# Updates the header column indices with the headers found in the row, and returns whether it's the header row
+def match_header_row(
+    columns: List[str], response: dict, header_column_index: dict[str, int]
+):
+    matched_headers = {
+        key: response[key].strip()
+        for key in HEADER_KEYS
+        if response[key].strip() != "" and response[key].strip() in columns
+    }
+
+    # If any column matches with the required header value, reset the results obtained from previous rows
+    if len(matched_headers) > 0:
+        for key in HEADER_KEYS:
+            header_column_index[key] = -1
+    for key, header in matched_headers.items():
+        header_column_index[key] = columns.index(header)
+
+    # Required number of headers to detect a header row: 4, OK to also have: >50% (2 or more)
+    existence_count = len(
+        [index for index in header_column_index.values() if index != -1]
+    )
+    return existence_count >= 2
+
+
+def get_separate_header_row(columns: List[str], table_matrix_indices: dict[str, int]):
+    result_columns = []
+    for column in columns[
+        table_matrix_indices["left"] : table_matrix_indices["right"] + 1
+    ]:
+        if str(column).strip().startswith("Unnamed:"):
+            result_columns.append("")
+        else:
+            result_columns.append(column)
+    return result_columns
+
+
+# Text rows padded to the same width
+def to_cells(text_rows: List[List[str]], width: int):
+    return np.array(
+        [row + [""] * (width - len(row)) for row in text_rows], dtype=object
+    ).reshape(-1, width)
+
+
+def is_unnamed(texts: np.ndarray):
+    return (
+        pd.Series(texts, dtype=object).str.startswith("Unnamed:").to_numpy(dtype=bool)
+    )
+
+
+def to_numbers(texts: np.ndarray):
+    # pandas finds the numbers, but they're parsed like float() as pandas can differ in the last digit
+    is_number = (
+        pd.to_numeric(pd.Series(texts, dtype=object), errors="coerce")
+        .notna()
+        .to_numpy(dtype=bool)
+    )
+    numbers = np.full(len(texts), np.nan)
+    numbers[is_number] = texts[is_number].astype(float)
+    return numbers
+
+
+# Same as int(float(text)) for each cell, keeping the text when it isn't a number
+def to_integers(texts: np.ndarray):
+    values = texts.copy()
+    numbers = to_numbers(texts)
+    is_integer = np.isfinite(numbers)
+    values[is_integer] = [int(number) for number in numbers[is_integer]]
+    return values
+
+
+# Same as float(text) for each cell, keeping the text when it isn't a number
+def to_floats(texts: np.ndarray):
+    values = texts.copy()
+    numbers = to_numbers(texts)
+    # float() also reads "nan", which can't be told apart from text once coerced
+    is_float = ~np.isnan(numbers) | (
+        pd.Series(texts, dtype=object).str.lower().isin(["nan", "+nan", "-nan"])
+    ).to_numpy(dtype=bool)
+    values[is_float] = numbers[is_float].tolist()
+    return values
+
+
+def extract_items(cells: np.ndarray, header_column_index: dict[str, int]):
+    number_of_rows = len(cells)
+    valid_counter = np.zeros(number_of_rows, dtype=int)
+    item_columns = []
+    for key in HEADER_KEYS:
+        if header_column_index[key] == -1:
+            item_columns.append(np.full(number_of_rows, "", dtype=object))
+            continue
+
+        texts = cells[:, header_column_index[key]]
+        valid_counter += texts != ""
+        if key in ["barcode", "quantity"]:
+            values = to_integers(texts)
+        elif key == "price":
+            values = to_floats(texts)
+        else:
+            values = texts.copy()
+        values[is_unnamed(texts)] = ""
+        item_columns.append(values)
+
+    # If lesser than 50%, it's noisy
+    valid_threshold = 2
+    items = np.stack(item_columns, axis=1)[valid_counter >= valid_threshold]
+    return items.tolist()
+
+
+def extract_separate_sheet_rows(
+    cells: np.ndarray,
+    table_matrix_indices: dict[str, int],
+    header_column_index: dict[str, int],
+):
+    left = table_matrix_indices["left"]
+    right = table_matrix_indices["right"]
+    required_cells = cells[:, left : right + 1]
+    if required_cells.shape[1] == 0:
+        return [[] for _ in range(len(cells))]
+
+    # Checking index of column with real value despite knowing matrix to avoid noisy row
+    has_value = required_cells != ""
+    has_any_value = has_value.any(axis=1)
+    lindex = np.where(has_any_value, has_value.argmax(axis=1), 0)
+    rindex = np.where(
+        has_any_value,
+        required_cells.shape[1] - 1 - has_value[:, ::-1].argmax(axis=1),
+        0,
+    )
+    # If lesser than 50%, it's noisy
+    is_valid_row = ((rindex + 1) - lindex) >= ((right + 1) - left) / 2
+
+    # A value is converted to a whole number when the first column with the same text is the barcode or quantity column
+    is_numeric_column = np.zeros(cells.shape, dtype=bool)
+    for key in ["barcode", "quantity"]:
+        column_index = header_column_index[key]
+        if column_index == -1:
+            continue
+        column = cells[:, [column_index]]
+        is_first_occurrence = ~(cells[:, :column_index] == column).any(axis=1)
+        is_numeric_column |= (cells == column) & is_first_occurrence[:, None]
+
+    result_cells = required_cells[is_valid_row].copy()
+    is_numeric_cell = is_numeric_column[:, left : right + 1][is_valid_row]
+    result_cells[is_numeric_cell] = to_integers(result_cells[is_numeric_cell])
+    result_cells[
+        is_unnamed(required_cells[is_valid_row].ravel()).reshape(result_cells.shape)
+    ] = ""
+    return result_cells.tolist()
+
+
+def set_status(sheet_analysis: SheetAnalysis):
+    # Skipped sheets keep the reason they were skipped for
+    if sheet_analysis.status == "SKIPPED":
+        return
+    header_column_index = sheet_analysis.header_column_index
+
+    # Update summary based on GPT analysis result
+    existence_count = len(
+        [index for index in header_column_index.values() if index != -1]
+    )
+    if existence_count == 4:
+        sheet_analysis.status = "PROCESSED"
+    elif existence_count >= 2:
+        sheet_analysis.status = "PARTIALLY PROCESSED"
+        sheet_analysis.comments = "Couldn't detect any headers that relate to"
+        if header_column_index["barcode"] == -1:
+            sheet_analysis.comments += " barcode,"
+        if header_column_index["quantity"] == -1:
+            sheet_analysis.comments += " quantity,"
+        if header_column_index["product"] == -1:
+            sheet_analysis.comments += " product description,"
+        if header_column_index["price"] == -1:
+            sheet_analysis.comments += " unit price,"
+        sheet_analysis.comments = sheet_analysis.comments[
+            0 : len(sheet_analysis.comments) - 1
+        ]
+    else:
+        sheet_analysis.status = "NOT PROCESSED"
+        if not sheet_analysis.completed:
+            sheet_analysis.comments = (
+                "Couldn't complete the header analysis. Try re-running the application."
+            )
+        elif existence_count == 1:
+            sheet_analysis.comments = "Could detect just one header that relate to barcode, quantity, product description or unit price."
+        else:
+            sheet_analysis.comments = "Couldn't detect any headers that relate to barcode, quantity, product description, unit price."
+
+
+def calculate_table_matrix_indices(
+    table_matrix_indices: dict[str, int],
+    cells: np.ndarray,
+    header_column_index: dict[str, int],
+):
+    left_indices, right_indices = get_row_bounds(cells, header_column_index)
+    table_matrix_indices["left"] = get_mode(left_indices)
+    table_matrix_indices["right"] = get_mode(right_indices)
+
+
+# First and last columns with a value in each row that has any
+def get_row_bounds(cells: np.ndarray, header_column_index: dict[str, int]):
+    # The header columns count as values even in the rows where they're empty
+    has_value = cells != ""
+    header_columns = [index for index in header_column_index.values() if index != -1]
+    has_value[:, header_columns] = True
+    has_value = has_value[has_value.any(axis=1)]
+
+    left_indices = has_value.argmax(axis=1)
+    right_indices = has_value.shape[1] - 1 - has_value[:, ::-1].argmax(axis=1)
+    return left_indices, right_indices
+
+
+def get_mode(values: np.ndarray):
+    mode_counter = ModeCounter()
+    mode_counter.add(values)
+    return mode_counter.get_mode()
+
+
+# Most common value, the first one found on a tie like statistics.mode. Values can be added in chunks
+class ModeCounter:
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.first_indices: dict[int, int] = {}
+        self.number_of_values = 0
+
+    def add(self, values: np.ndarray):
+        unique_values, first_indices, counts = np.unique(
+            values, return_index=True, return_counts=True
+        )
+        for value, first_index, count in zip(
+            unique_values.tolist(), first_indices.tolist(), counts.tolist()
+        ):
+            self.counts[value] = self.counts.get(value, 0) + count
+            self.first_indices.setdefault(value, self.number_of_values + first_index)
+        self.number_of_values += len(values)
+
+    def get_mode(self):
+        if len(self.counts) == 0:
+            return statistics.mode([])
+        return min(
+            self.counts,
+            key=lambda value: (-self.counts[value], self.first_indices[value]),
+        )
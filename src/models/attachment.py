@@ -1,5 +1,44 @@
+# Currently supported attachments: .xls or .xlsx
+EXCEL_FILE_EXTENSIONS = (".xls", ".xlsx")
+
+
 class Attachment:
 
-    def __init__(self, name: str, content):
+    def __init__(
+        self,
+        name: str,
+        content,
+        id: str = None,
+        content_type: str = None,
+        size: int = None,
+        path: str = None,
+        content_hash: str = None,
+    ):
         self.name: str = name
-        self.content = content
+        self._content = content
+        self.id: str = id
+        self.content_type: str = content_type
+        self.size: int = size
+        self.path: str = path
+        # SHA-256 of the content, which is its key in the blob store
+        self.content_hash: str = content_hash
+
+    @property
+    def is_excel_file(self) -> bool:
+        return self.name.lower().endswith(EXCEL_FILE_EXTENSIONS)
+
+    @property
+    def is_in_memory(self) -> bool:
+        return self._content is not None
+
+    @property
+    def content(self):
+        # Downloaded attachments are kept on disk and only read when needed
+        if self._content is None and self.path is not None:
+            with open(self.path, "rb") as file:
+                return file.read()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
@@ -0,0 +1,20 @@
+from typing import List
+
+
+class SheetAnalysis:
+
+    def __init__(self):
+        self.header_column_index: dict[str, int] = {
+            "barcode": -1,
+            "quantity": -1,
+            "product": -1,
+            "price": -1,
+        }
+        # Rows for the consolidated sheet as [barcode, quantity, product description, unit price]
+        self.items: List[list] = []
+        # Rows for the separate sheet, including the header row
+        self.separate_sheet: List[list] = []
+        self.status: str = ""
+        self.comments: str = ""
+        # Whether the header analysis could be completed, results are only reused if so
+        self.completed: bool = True
@@ -0,0 +1,83 @@
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+# Marks the end of the items produced by a stage
+END_OF_STAGE = object()
+
+
+class Pipeline:
+
+    def __init__(self, queue_size: int):
+        # Bounded queues keep a fast stage from running too far ahead of a slow one
+        self.queue_size = queue_size
+        self.threads: List[threading.Thread] = []
+        self.errors: List[Exception] = []
+        self.failed = threading.Event()
+
+    def add_source(self, items: Iterable):
+        output_queue = queue.Queue(maxsize=self.queue_size)
+
+        def run():
+            try:
+                for item in items:
+                    if self.failed.is_set():
+                        break
+                    output_queue.put(item)
+            except Exception as ex:
+                self.fail(ex)
+            finally:
+                output_queue.put(END_OF_STAGE)
+
+        self.start(run)
+        return output_queue
+
+    def add_stage(
+        self,
+        input_queue: queue.Queue,
+        process: Callable,
+        finish: Callable = None,
+        has_output: bool = True,
+    ):
+        output_queue = queue.Queue(maxsize=self.queue_size) if has_output else None
+        emit = output_queue.put if has_output else lambda item: None
+
+        def run():
+            while True:
+                item = input_queue.get()
+                if item is END_OF_STAGE:
+                    break
+                # After a failure the input is still drained so earlier stages never block
+                if self.failed.is_set():
+                    continue
+                try:
+                    process(item, emit)
+                except Exception as ex:
+                    self.fail(ex)
+
+            try:
+                if finish is not None and not self.failed.is_set():
+                    finish(emit)
+            except Exception as ex:
+                self.fail(ex)
+            finally:
+                if has_output:
+                    output_queue.put(END_OF_STAGE)
+
+        self.start(run)
+        return output_queue
+
+    def start(self, run: Callable):
+        thread = threading.Thread(target=run, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def fail(self, ex: Exception):
+        self.errors.append(ex)
+        self.failed.set()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
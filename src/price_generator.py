@@ -1,12 +1,14 @@
 import json
 from typing import List
 
-import requests
 import numpy as ny
-from omegaconf import DictConfig
 
+from src import http_client
 from src.models.consolidated_sheet import ConsolidatedSheetItem
 
+# Maximum number of GTINs looked up in a single PriceRunner request
+PRICE_RUNNER_BATCH_SIZE = 100
+
 
 def fetch_prices(
     items: List[ConsolidatedSheetItem],
@@ -28,7 +30,7 @@ def fetch_prices(
                 )
             )
 
-        response = requests.get(
+        response = http_client.get(
             url="https://api.pricerunner.com/public/v2/product/offers/UK/gtin14s",
             params=params,
             headers={"tokenId": price_runner_token},
@@ -96,22 +98,3 @@ def fetch_prices(
                 pass
     except Exception as ex:
         system_logger.debug(ex)
-
-
-def get_price_results(
-    items: List[ConsolidatedSheetItem],
-    config: DictConfig,
-    system_logger: "loguru.system_logger",
-):
-    print("⏳ Fetching PriceRunner details")
-    skip = 0
-    take = 100
-    sliced_results = items[skip : skip + take]
-    fetch_prices(sliced_results, str(config.secrets.price_runner_token), system_logger)
-
-    while len(items) > len(items[: skip + take]):
-        skip += 100
-        sliced_results = items[skip : skip + take]
-        fetch_prices(
-            sliced_results, str(config.secrets.price_runner_token), system_logger
-        )
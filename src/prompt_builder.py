@@ -0,0 +1,56 @@
+from typing import List
+
+from src.workbook_reader import get_cell_text, write_csv
+
+DEFAULT_PROMPT_TOKENS = 2000
+# Headers are short, so longer cells are only descriptions or notes
+MAX_CELL_LENGTH = 40
+# Rough average for CSV content, as the tokenizer isn't available locally
+CHARACTERS_PER_TOKEN = 4
+
+
+# Builds the CSV sent to the header analysis from the first rows, leaving out the empty rows and columns.
+# The first line keeps the original column numbers of the columns that are sent.
+# Returns the CSV and the full text of the truncated cells, to map the response back
+def build_prompt(
+    rows: List[list], number_of_rows: int, max_tokens: int = DEFAULT_PROMPT_TOKENS
+):
+    text_rows = [
+        [get_cell_text(value) for value in row] for row in rows[:number_of_rows]
+    ]
+    text_rows = [row for row in text_rows if any(row)]
+    column_indices = [
+        column_index
+        for column_index in range(max((len(row) for row in text_rows), default=0))
+        if any(column_index < len(row) and row[column_index] for row in text_rows)
+    ]
+
+    original_texts = {}
+    prompt_rows = []
+    for row in text_rows:
+        prompt_row = []
+        for column_index in column_indices:
+            text = row[column_index] if column_index < len(row) else ""
+            if len(text) > MAX_CELL_LENGTH:
+                truncated_text = text[:MAX_CELL_LENGTH].strip()
+                original_texts.setdefault(truncated_text, text)
+                text = truncated_text
+            prompt_row.append(text)
+        prompt_rows.append(prompt_row)
+
+    # Rows at the end are left out when the sample doesn't fit in the budget, but never the first one
+    csv_content = write_csv(prompt_rows, column_indices)
+    while len(prompt_rows) > 1 and len(csv_content) > max_tokens * CHARACTERS_PER_TOKEN:
+        prompt_rows = prompt_rows[:-1]
+        csv_content = write_csv(prompt_rows, column_indices)
+    return csv_content, original_texts
+
+
+# Replaces the truncated headers in the response with the text in the sheet
+def restore_headers(response: dict, original_texts: dict):
+    if response is None:
+        return None
+    return {
+        key: original_texts.get(header.strip(), header)
+        for key, header in response.items()
+    }
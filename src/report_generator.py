@@ -1,13 +1,31 @@
 import os
+import threading
 from typing import List
 
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Font
+from openpyxl.utils import get_column_letter
 from openpyxl.workbook import Workbook
 
 from src.models.consolidated_sheet import ConsolidatedSheetItem
 from src.models.report_sheet_item import ReportSheetItem
 from src.models.separate_sheet_metadata import SeparateSheetMetadata
 
+SUMMARY_HEADERS = ["SENDER", "TIME", "SHEET", "STATUS", "COMMENTS", "FILE"]
+CONSOLIDATED_HEADERS = [
+    "SENDER",
+    "BARCODE",
+    "QUANTITY",
+    "PRODUCT DESCRIPTION",
+    "UNIT PRICE",
+    "PRICERUNNER - MEDIAN PRICE",
+    "PRICERUNNER - LOWEST PRICE",
+    "PRICERUNNER - RETAILER (LOWEST PRICE)",
+    "PRICERUNNER - HIGHEST PRICE",
+    "PRICERUNNER - RETAILER (HIGHEST PRICE)",
+    "PRICERUNNER - AVERAGE PRICE",
+]
+
 
 def generate_report(
     output_directory: str,
@@ -21,18 +39,9 @@ def generate_report(
     wb.remove(default_sheet)
 
     ws = wb.create_sheet(title="Summary")
-    ws.append(["SENDER", "TIME", "SHEET", "STATUS", "COMMENTS", "FILE"])
+    ws.append(SUMMARY_HEADERS)
     for row_index in range(len(report_sheet_items)):
-        ws.append(
-            [
-                report_sheet_items[row_index].sender,
-                report_sheet_items[row_index].received_at,
-                report_sheet_items[row_index].sheet_name,
-                report_sheet_items[row_index].status,
-                report_sheet_items[row_index].comments,
-                report_sheet_items[row_index].file_name,
-            ]
-        )
+        ws.append(get_summary_row(report_sheet_items[row_index]))
 
         if str(report_sheet_items[row_index].sheet_name).strip():
             add_hyperlink(
@@ -51,37 +60,9 @@ def generate_report(
     update_status(ws)
 
     ws = wb.create_sheet(title="Consolidated")
-    ws.append(
-        [
-            "SENDER",
-            "BARCODE",
-            "QUANTITY",
-            "PRODUCT DESCRIPTION",
-            "UNIT PRICE",
-            "PRICERUNNER - MEDIAN PRICE",
-            "PRICERUNNER - LOWEST PRICE",
-            "PRICERUNNER - RETAILER (LOWEST PRICE)",
-            "PRICERUNNER - HIGHEST PRICE",
-            "PRICERUNNER - RETAILER (HIGHEST PRICE)",
-            "PRICERUNNER - AVERAGE PRICE",
-        ]
-    )
+    ws.append(CONSOLIDATED_HEADERS)
     for row in consolidated_sheet_items:
-        ws.append(
-            [
-                row.sender,
-                row.barcode,
-                row.quantity,
-                row.product_description,
-                row.unit_price,
-                row.price_runner_details.median,
-                row.price_runner_details.lowest_price,
-                row.price_runner_details.lowest_price_retailer,
-                row.price_runner_details.highest_price,
-                row.price_runner_details.highest_price_retailer,
-                row.price_runner_details.average_price,
-            ]
-        )
+        ws.append(get_consolidated_row(row))
     adjust_column_style(ws)
 
     for sheet in separate_sheets:
@@ -94,6 +75,112 @@ def generate_report(
     wb.save(os.path.join(output_directory, "Report.xlsx"))
 
 
+def get_summary_row(report_sheet_item: ReportSheetItem):
+    return [
+        report_sheet_item.sender,
+        report_sheet_item.received_at,
+        report_sheet_item.sheet_name,
+        report_sheet_item.status,
+        report_sheet_item.comments,
+        report_sheet_item.file_name,
+    ]
+
+
+def get_consolidated_row(item: ConsolidatedSheetItem):
+    return [
+        item.sender,
+        item.barcode,
+        item.quantity,
+        item.product_description,
+        item.unit_price,
+        item.price_runner_details.median,
+        item.price_runner_details.lowest_price,
+        item.price_runner_details.lowest_price_retailer,
+        item.price_runner_details.highest_price,
+        item.price_runner_details.highest_price_retailer,
+        item.price_runner_details.average_price,
+    ]
+
+
+# Writes the report while the messages are analysed, so the rows of the separate and consolidated
+# sheets don't have to be kept until the end. Write-only sheets can't be changed once a row is
+# written, so their column widths fit the header row
+class ReportWriter:
+
+    def __init__(self, output_directory: str):
+        self.path = os.path.join(output_directory, "Report.xlsx")
+        self.workbook = Workbook(write_only=True)
+        # Sheets are in the order they're created, and the summary is only written at the end
+        self.summary_sheet = self.workbook.create_sheet(title="Summary")
+        self.consolidated_sheet = self.workbook.create_sheet(title="Consolidated")
+        append_header_row(self.consolidated_sheet, CONSOLIDATED_HEADERS)
+        self.separate_sheets = {}
+        # The consolidated items are written by the pricing while sheets are still being analysed
+        self.lock = threading.Lock()
+
+    def append_consolidated_items(self, items: List[ConsolidatedSheetItem]):
+        with self.lock:
+            for item in items:
+                self.consolidated_sheet.append(get_consolidated_row(item))
+
+    # The first rows of a separate sheet start with its header row
+    def append_separate_rows(self, name: str, rows: List[list]):
+        with self.lock:
+            ws = self.separate_sheets.get(name)
+            if ws is None:
+                ws = self.workbook.create_sheet(title=name)
+                self.separate_sheets[name] = ws
+                append_header_row(ws, rows[0])
+                rows = rows[1:]
+            for row in rows:
+                ws.append(row)
+
+    # Finished sheets are closed so their temporary files aren't kept open
+    def close_separate_sheet(self, name: str):
+        with self.lock:
+            ws = self.separate_sheets.pop(name, None)
+            if ws is not None:
+                ws.close()
+
+    def save(self, report_sheet_items: List[ReportSheetItem]):
+        print("⏳ Generating report")
+        ws = self.summary_sheet
+        rows = [SUMMARY_HEADERS] + [
+            get_summary_row(item) for item in report_sheet_items
+        ]
+        for column_index in range(len(SUMMARY_HEADERS)):
+            max_length = max(len(str(row[column_index])) for row in rows)
+            ws.column_dimensions[get_column_letter(column_index + 1)].width = (
+                max_length + 1
+            )
+
+        ws.append([get_header_cell(ws, value) for value in SUMMARY_HEADERS])
+        for report_sheet_item, row in zip(report_sheet_items, rows[1:]):
+            cells = [WriteOnlyCell(ws, value=value) for value in row]
+            if str(report_sheet_item.sheet_name).strip():
+                set_hyperlink(
+                    cells[2], f"#'{str(report_sheet_item.sheet_name).strip()}'!A1"
+                )
+            set_hyperlink(cells[5], report_sheet_item.file_path)
+            cells[3].fill = get_status_fill(report_sheet_item.status)
+            ws.append(cells)
+        self.workbook.save(self.path)
+
+
+def append_header_row(worksheet, header_row: list):
+    for column_index, value in enumerate(header_row):
+        worksheet.column_dimensions[get_column_letter(column_index + 1)].width = (
+            len(str(value)) + 1
+        )
+    worksheet.append([get_header_cell(worksheet, value) for value in header_row])
+
+
+def get_header_cell(worksheet, value):
+    cell = WriteOnlyCell(worksheet, value=value)
+    cell.font = Font(bold=True)
+    return cell
+
+
 def adjust_column_style(worksheet):
     for col in worksheet.columns:
         max_length = 0
@@ -110,29 +197,28 @@ def adjust_column_style(worksheet):
 
 
 def update_status(worksheet):
-    yellow_fill = PatternFill(
-        start_color="FFFF00", end_color="FFFF00", fill_type="solid"
-    )
-    green_fill = PatternFill(
-        start_color="90EE90", end_color="90EE90", fill_type="solid"
-    )
-    red_fill = PatternFill(
-        start_color="FF6347", end_color="FF6347", fill_type="solid"
-    )  # Red color
-
     for row in worksheet.iter_rows(
         min_col=4, max_col=4, min_row=2, max_row=worksheet.max_row
     ):
         for cell in row:
-            if str(cell.value).strip() == "PROCESSED":
-                cell.fill = green_fill
-            elif str(cell.value).strip() == "PARTIALLY PROCESSED":
-                cell.fill = yellow_fill
-            else:
-                cell.fill = red_fill
+            cell.fill = get_status_fill(cell.value)
+
+
+def get_status_fill(status):
+    if str(status).strip() == "PROCESSED":
+        return PatternFill(start_color="90EE90", end_color="90EE90", fill_type="solid")
+    if str(status).strip() == "PARTIALLY PROCESSED":
+        return PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+    if str(status).strip() == "SKIPPED":
+        return PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+    # Red color
+    return PatternFill(start_color="FF6347", end_color="FF6347", fill_type="solid")
 
 
 def add_hyperlink(worksheet, row, column, link):
-    cell = worksheet.cell(row=row, column=column)
+    set_hyperlink(worksheet.cell(row=row, column=column), link)
+
+
+def set_hyperlink(cell, link):
     cell.hyperlink = link
     cell.font = Font(color="0000FF", underline="single")
@@ -0,0 +1,46 @@
+from typing import List
+
+from src.header_detector import is_gtin, normalize, to_number
+
+# Number of rows from the top of a sheet checked, the most the header analysis is sent
+SAMPLE_ROWS = 50
+MIN_ROWS = 2
+MIN_COLUMNS = 2
+
+
+# Returns why a sheet can't be a product table, or None if it could be one.
+# Only sheets that clearly aren't, such as cover pages, terms and conditions or notes, are skipped
+def get_skip_reason(rows: List[list]):
+    rows = [row for row in rows[:SAMPLE_ROWS] if any(normalize(value) for value in row)]
+    if len(rows) < MIN_ROWS:
+        return "Not a product table: the sheet has less than two rows with values."
+    number_of_columns = max(
+        len([value for value in row if normalize(value)]) for row in rows
+    )
+    if number_of_columns < MIN_COLUMNS:
+        return "Not a product table: the sheet has a single column of values."
+
+    # A barcode is enough for the sheet to be analysed
+    values = [value for row in rows for value in row if normalize(value)]
+    if any(is_gtin(value) for value in values):
+        return None
+    if all(to_number(value) is None for value in values):
+        return "Not a product table: the sheet only has text."
+    if len(get_numeric_columns(rows)) == 0:
+        return "Not a product table: none of the columns are mostly numbers, like quantities or prices."
+    return None
+
+
+# Columns where at least half of the values are numbers
+def get_numeric_columns(rows: List[list]):
+    numeric_columns = []
+    for column_index in range(max((len(row) for row in rows), default=0)):
+        column_values = [
+            row[column_index]
+            for row in rows
+            if column_index < len(row) and normalize(row[column_index])
+        ]
+        numbers = [value for value in column_values if to_number(value) is not None]
+        if len(numbers) > 0 and len(numbers) * 2 >= len(column_values):
+            numeric_columns.append(column_index)
+    return numeric_columns
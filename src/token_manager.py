@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+from msal import PublicClientApplication, SerializableTokenCache
+
+TOKEN_CACHE_PATH = os.path.join("cache", "token_cache.bin")
+AUTHORITY = "https://login.microsoftonline.com/common/"
+# Access tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 300
+LOCK_TIMEOUT = 10
+# A lock file older than this is left over from a crashed run
+STALE_LOCK_AGE = 60
+
+
+class FileLock:
+
+    def __init__(self, path: str, timeout: float = LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.file_descriptor = None
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self.file_descriptor = os.open(
+                    self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > STALE_LOCK_AGE:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f"Couldn't acquire the lock {self.path}")
+                time.sleep(0.1)
+
+    def __exit__(self, *args):
+        os.close(self.file_descriptor)
+        os.remove(self.path)
+
+
+class TokenManager:
+
+    def __init__(self, client_id: str, scopes: list[str], cache_path=TOKEN_CACHE_PATH):
+        self.scopes = scopes
+        self.cache_path = cache_path
+        self.cache = SerializableTokenCache()
+        self.load_cache()
+        self.app = PublicClientApplication(
+            client_id, authority=AUTHORITY, token_cache=self.cache
+        )
+        self.lock = threading.Lock()
+        self.access_token = ""
+        self.expires_at = 0.0
+
+    def load_cache(self):
+        if os.path.exists(self.cache_path):
+            with FileLock(self.cache_path + ".lock"):
+                with open(self.cache_path, "r", encoding="utf-8") as file:
+                    self.cache.deserialize(file.read())
+
+    def save_cache(self):
+        if not self.cache.has_state_changed:
+            return
+        if not os.path.exists(os.path.dirname(self.cache_path)):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with FileLock(self.cache_path + ".lock"):
+            # The cache holds refresh tokens, so it's created readable by the current user only
+            temp_path = self.cache_path + ".tmp"
+            file_descriptor = os.open(
+                temp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600
+            )
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+                file.write(self.cache.serialize())
+            os.replace(temp_path, self.cache_path)
+        self.cache.has_state_changed = False
+
+    def sign_in(self):
+        with self.lock:
+            # A cached account signs in without user interaction
+            result = self.acquire_token_silent(force_refresh=False)
+            if result is None or "access_token" not in result:
+                flow = self.app.initiate_device_flow(scopes=self.scopes)
+                print(f"🚀 {flow['message']}")
+                result = self.app.acquire_token_by_device_flow(flow)
+            self.set_result(result)
+            return result
+
+    def acquire_token_silent(self, force_refresh: bool):
+        accounts = self.app.get_accounts()
+        if len(accounts) == 0:
+            return None
+        return self.app.acquire_token_silent(
+            scopes=self.scopes, account=accounts[0], force_refresh=force_refresh
+        )
+
+    def set_result(self, result: dict):
+        if result is not None and "access_token" in result:
+            self.access_token = result["access_token"]
+            self.expires_at = time.time() + int(result.get("expires_in", 0))
+        self.save_cache()
+
+    def get_access_token(self):
+        with self.lock:
+            # Refreshed ahead of expiry so requests don't fail with an expired token
+            if time.time() >= self.expires_at - REFRESH_MARGIN:
+                self.refresh_access_token()
+            return self.access_token
+
+    def refresh(self, expired_access_token: str):
+        with self.lock:
+            # Another worker may have already refreshed the token while this one was waiting
+            if self.access_token == expired_access_token:
+                self.refresh_access_token()
+
+    # Called with the lock held
+    def refresh_access_token(self):
+        result = self.acquire_token_silent(force_refresh=True)
+        self.set_result(result)
+        if result is None or "access_token" not in result:
+            # Handing out the stale token would make every request refresh it again
+            error = (
+                "no signed in account"
+                if result is None
+                else result.get("error_description", result.get("error"))
+            )
+            raise Exception(f"Couldn't refresh the access token: {error}")
@@ -0,0 +1,261 @@
+import csv
+import functools
+import io
+import zipfile
+from typing import BinaryIO, Callable, Iterable, List, Union
+
+import openpyxl
+import xlrd
+from openpyxl.utils.exceptions import InvalidFileException
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
+
+try:
+    from openpyxl.worksheet._reader import WorkSheetParser
+except ImportError:
+    WorkSheetParser = None
+
+# Legacy .xls workbooks are OLE2 compound documents
+XLS_SIGNATURE = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+# Raised when an attachment can't be read as a workbook
+WORKBOOK_ERRORS = (
+    OSError,
+    KeyError,
+    ValueError,
+    zipfile.BadZipFile,
+    InvalidFileException,
+    xlrd.XLRDError,
+)
+
+
+# Reads a workbook from its path, a binary file or its bytes
+def read_sheets(attachment_file: Union[str, BinaryIO, bytes, memoryview]):
+    attachment_file = open_attachment_file(attachment_file)
+    if is_xls_file(attachment_file):
+        return read_xls_sheets(attachment_file)
+    return read_xlsx_sheets(attachment_file)
+
+
+# Yields the name of each sheet with a function that reads its visible rows one at a time.
+# The rows aren't padded to the same width, and can be read again while the sheet is current
+def stream_sheets(attachment_file: Union[str, BinaryIO, bytes, memoryview]):
+    attachment_file = open_attachment_file(attachment_file)
+    if is_xls_file(attachment_file):
+        yield from stream_xls_sheets(attachment_file)
+    else:
+        yield from stream_xlsx_sheets(attachment_file)
+
+
+def open_attachment_file(attachment_file: Union[str, BinaryIO, bytes, memoryview]):
+    if isinstance(attachment_file, (bytes, bytearray, memoryview)):
+        return io.BytesIO(attachment_file)
+    return attachment_file
+
+
+def is_xls_file(attachment_file: Union[str, BinaryIO]):
+    if isinstance(attachment_file, str):
+        with open(attachment_file, "rb") as file:
+            signature = file.read(len(XLS_SIGNATURE))
+    else:
+        signature = attachment_file.read(len(XLS_SIGNATURE))
+        attachment_file.seek(0)
+    return signature == XLS_SIGNATURE
+
+
+# Reads the visible rows of every sheet in a single pass over the workbook
+def read_xlsx_sheets(attachment_file: Union[str, BinaryIO]):
+    sheets = {}
+    workbook = openpyxl.load_workbook(attachment_file, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            if isinstance(worksheet, ReadOnlyWorksheet):
+                sheets[worksheet.title] = read_visible_rows(workbook, worksheet)
+    finally:
+        workbook.close()
+    return sheets
+
+
+def stream_xlsx_sheets(attachment_file: Union[str, BinaryIO]):
+    workbook = openpyxl.load_workbook(attachment_file, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            if isinstance(worksheet, ReadOnlyWorksheet):
+                # Each read parses the sheet again from the workbook file
+                yield worksheet.title, functools.partial(
+                    trim_rows, functools.partial(iter_visible_rows, workbook, worksheet)
+                )
+    finally:
+        workbook.close()
+
+
+def read_visible_rows(
+    workbook: openpyxl.Workbook, worksheet: ReadOnlyWorksheet
+) -> List[list]:
+    return pad_rows(list(iter_visible_rows(workbook, worksheet)))
+
+
+def iter_visible_rows(workbook: openpyxl.Workbook, worksheet: ReadOnlyWorksheet):
+    # The parser is private to openpyxl, which is pinned for it. Without it every row is read
+    if not has_worksheet_parser(workbook, worksheet):
+        yield from iter_worksheet_rows(worksheet)
+        return
+
+    # The read-only worksheet doesn't expose the row dimensions, so the rows are parsed
+    # the same way it does, which also collects the hidden attribute of each row
+    with worksheet._get_source() as source:
+        parser = WorkSheetParser(
+            source,
+            worksheet._shared_strings,
+            data_only=True,
+            epoch=workbook.epoch,
+            date_formats=workbook._date_formats,
+            timedelta_formats=workbook._timedelta_formats,
+        )
+        row_counter = 0
+        for row_number, cells in parser.parse():
+            # Rows without any cells are missing from the file
+            for _ in range(row_counter + 1, row_number):
+                yield []
+            row_counter = row_number
+
+            row_dimension = getattr(parser, "row_dimensions", {}).get(
+                str(row_number), {}
+            )
+            if row_dimension.get("hidden") in ["1", "true"]:
+                continue
+
+            row = []
+            for cell in cells:
+                if cell["value"] is None or cell["data_type"] == "e":
+                    continue
+                row.extend([None] * (cell["column"] - len(row)))
+                row[cell["column"] - 1] = get_cell_value(cell["value"])
+            yield row
+
+
+def has_worksheet_parser(workbook: openpyxl.Workbook, worksheet: ReadOnlyWorksheet):
+    return (
+        WorkSheetParser is not None
+        and hasattr(worksheet, "_get_source")
+        and hasattr(worksheet, "_shared_strings")
+        and hasattr(workbook, "_date_formats")
+        and hasattr(workbook, "_timedelta_formats")
+    )
+
+
+# Reads the rows with the public API, which can't tell which rows are hidden
+def iter_worksheet_rows(worksheet: ReadOnlyWorksheet):
+    for cells in worksheet.iter_rows():
+        yield [
+            (
+                None
+                if cell.value is None or cell.data_type == "e"
+                else get_cell_value(cell.value)
+            )
+            for cell in cells
+        ]
+
+
+def read_xls_sheets(attachment_file: Union[str, BinaryIO]):
+    sheets = {}
+    for sheet_name, get_rows in stream_xls_sheets(attachment_file):
+        sheets[sheet_name] = pad_rows(list(get_rows()))
+    return sheets
+
+
+def stream_xls_sheets(attachment_file: Union[str, BinaryIO]):
+    if isinstance(attachment_file, str):
+        workbook = xlrd.open_workbook(
+            attachment_file, formatting_info=True, on_demand=True
+        )
+    else:
+        workbook = xlrd.open_workbook(
+            file_contents=attachment_file.read(), formatting_info=True, on_demand=True
+        )
+    try:
+        for sheet_index in range(workbook.nsheets):
+            # The format is limited to 65536 rows, so a whole sheet is loaded at a time
+            sheet = workbook.sheet_by_index(sheet_index)
+            yield sheet.name, functools.partial(
+                trim_rows, functools.partial(iter_xls_rows, sheet, workbook.datemode)
+            )
+            workbook.unload_sheet(sheet_index)
+    finally:
+        workbook.release_resources()
+
+
+def iter_xls_rows(sheet: xlrd.sheet.Sheet, datemode: int):
+    for row_index in range(sheet.nrows):
+        row_info = sheet.rowinfo_map.get(row_index)
+        if row_info is not None and row_info.hidden:
+            continue
+        yield [get_xls_cell_value(cell, datemode) for cell in sheet.row(row_index)]
+
+
+def get_xls_cell_value(cell: xlrd.sheet.Cell, datemode: int):
+    if cell.ctype == xlrd.XL_CELL_TEXT:
+        return cell.value if cell.value != "" else None
+    if cell.ctype == xlrd.XL_CELL_NUMBER:
+        return get_cell_value(cell.value)
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        try:
+            return xlrd.xldate.xldate_as_datetime(cell.value, datemode)
+        except xlrd.xldate.XLDateError:
+            return get_cell_value(cell.value)
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    # Empty, blank and error cells
+    return None
+
+
+# Same rows as pad_rows without the padding. Empty rows are held back until a row with values follows
+def trim_rows(get_rows: Callable[[], Iterable[list]]):
+    number_of_empty_rows = 0
+    for row in get_rows():
+        while len(row) > 0 and row[-1] is None:
+            row.pop()
+        if len(row) == 0:
+            number_of_empty_rows += 1
+            continue
+        for _ in range(number_of_empty_rows):
+            yield []
+        number_of_empty_rows = 0
+        yield row
+
+
+def pad_rows(rows: List[list]):
+    for row in rows:
+        while len(row) > 0 and row[-1] is None:
+            row.pop()
+    # Trailing empty rows are dropped and the rest are padded to the same width
+    while len(rows) > 0 and len(rows[-1]) == 0:
+        rows.pop()
+    width = max((len(row) for row in rows), default=0)
+    for row in rows:
+        row.extend([None] * (width - len(row)))
+    return rows
+
+
+def get_cell_value(value):
+    # Whole numbers are stored as floats
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def get_cell_text(value):
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+def write_csv(rows: List[list], column_indices: List[int] = None):
+    csv_output = io.StringIO()
+    writer = csv.writer(csv_output, lineterminator="\n")
+    # Same layout as the sheets the header analysis model was trained on, which starts with the column numbers
+    if column_indices is None:
+        column_indices = range(max((len(row) for row in rows), default=0))
+    writer.writerow(column_indices)
+    writer.writerows(
+        [["" if value is None else value for value in row] for row in rows]
+    )
+    return csv_output.getvalue()
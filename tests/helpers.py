@@ -0,0 +1,73 @@
+import json
+from types import SimpleNamespace
+
+# Sheet with well labelled headers below an empty row
+SHEET_ROWS = [
+    [None, None, None, None],
+    ["Qty", "Description", "EAN", "Sale Price £"],
+    [300, "Sample Decléor 30ml Antidote Serum", 3395019917775, 12.95],
+    [1284, "Sample Cica Balm", 3395019909718, 12.5],
+]
+
+
+class FakeCompletions:
+
+    def __init__(self, content: str, finish_reason: str = "stop"):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(
+                    finish_reason=self.finish_reason,
+                    message=SimpleNamespace(content=self.content),
+                )
+            ]
+        )
+
+
+# Answers every sheet of a multi-sheet request with the same headers
+class FakeSheetsCompletions(FakeCompletions):
+
+    def __init__(self, response: dict):
+        super().__init__("")
+        self.response = response
+
+    def create(self, **request):
+        number_of_sheets = request["messages"][1]["content"].count("### Sheet ")
+        self.content = json.dumps(
+            {str(number): self.response for number in range(1, number_of_sheets + 1)}
+        )
+        return super().create(**request)
+
+
+# Local stand-in for the OpenAI Batch API which answers every request with the same headers
+def create_batch_output(batch_input: str, response: dict):
+    output_lines = []
+    for line in batch_input.splitlines():
+        request = json.loads(line)
+        completion = {
+            "choices": [
+                {
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": json.dumps(response)},
+                }
+            ]
+        }
+        output_lines.append(
+            json.dumps(
+                {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": completion},
+                    "error": None,
+                }
+            )
+        )
+    return "\n".join(output_lines)
+
+
+def create_client(completions: FakeCompletions):
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
@@ -1,17 +1,31 @@
 import base64
 import datetime
 import os.path
+import threading
+import time
 from typing import List
 
+import pytest
+from omegaconf import OmegaConf
+
+import src.app
+import src.blob_store
 from src.app import (
     set_tokens,
     get_tokens,
     api_request,
     append_messages,
     append_attachments,
-    create_temp_directory,
+    download_attachments,
+    download_attachment_content,
+    download_message_attachments,
+    load_delta_link,
+    save_delta_link,
     configure_logging,
+    save_messages,
+    wait_for_archived_attachments,
 )
+from src.models.attachment import Attachment
 from src.models.message import Message, Body, EmailAddress
 
 
@@ -24,12 +38,6 @@ def test_get_tokens():
     assert get_tokens() == ("access_token", "refresh_token")
 
 
-def test_create_temp_directory():
-    configure_logging()
-    create_temp_directory()
-    assert os.path.exists("./temp")
-
-
 def test_api_request():
     configure_logging()
     code = "InvalidAuthenticationToken"
@@ -97,12 +105,258 @@ def test_append_attachments():
     assert len(message.attachments) == 1
 
 
-# def test_process_messages():
-#     set_tokens(
-#         "EwB4A8l6BAAUbDba3x2OMJElkF7gJ4z/VbCPEz0AAXdihoLYfO/gFTFSEZxvdMDAZZhDqD1Mci2S6IL6DUBjP+dPE8yC057Gdz8d6WScTz2KNR7RHzjqWnGlDnO6MfWa+1+KyuR0yBS0qMHYe+BjOzk8mwzWFq6QMQ2LpLcJF9SZh20aSL3DQku30Xa4WAyH/WzmWIsox6yuxxlSvZngTHrKD+n+bBOXVO9H2Bv94PL6CzySHiixWWqT3Ck0eGAi8QED/IctiYQkf1u/L5aKovm111N+8z9FPTkHmw8Ka/INtUrGKqsIYhkDXLTNd/K3NLGFC4c42headZHqU0+SteTd0P3b9LyUTSOSYlgZJV7+71GKkLqbKbtFfM1RcE4DZgAACKO0fXaDZgWhSAJ5BFYXafjUCCPfpSExBSus23G1Z+m6VTPfpwphZKeZfgw15deqI8w043b6oP7D3nD1Z4vfYFD+KSoEj4SrUGzTyzKqhbGWLzV98vWeg8GWLeWvaiPHgmnG9blr28iS/G8aG+YNMfdPe/nzNGpmgly520A0uUDKpJV5vaGEjT8ySbyyUBnRfD2yoJKxKJBsTeqxZytBepxPVLD9u3BfNe88VOhyOi57m4QvG0r/Ro9mpo1xoKK5BDL7koHxf4FfgIwNMxNxX5cHnju0R8flwdp28tXtZ8p2qEQLeAywyY8ckX4JQgnnbc7RcQqTi/lSqV6wstv8Mjjy/7S9fR5/hteWLAjVbHUbjlRpqUMtevxWZ0bwUk/tDjdEaqo1GhNUPoFoiS5dx5jkMBbRlvgvoQaKtaYs9YPsX9xLtJnKiM/25Yir3gZUinOXVEsP49MK1kVDsoeDZZ3vEroSpseJ95r/k8mv+zR1/jRQa+N35sfffJatwl57wov2REYFUy783aosTYpgXVncG2MEicyutbqjfy0+nm+hTrkT5W2fFlShUhw4cP/vF/S0D7zRTlI5/C4jrS6wmJ3WTvI7ePe5nKXMP0xT7KfUcTdgDB80aTYcX99gugWiHjej+TgIG0ceyrHCwqVtLyZXkVyFnnAmEoxMb92PVeBeOViiP7CK79J2HO+aGZZnOtqi3nWTQDWGmF59HYI7n8CBdF1S8fuXEB9PWsSh8Zqems9MyDAoqXqwT8rfJAJ0BnXvqu97nwXn3cMVechDE7kqyIsC",
-#         "M.C508_BAY.0.U.-CvhZ9vnGYfOJApm5DuZdG9kNkRC1DeIxY68HlOgT03OtEcdQft!whEpHcPbHm9dd0oT98UDRma4CGK!i7iejmlGZLEQ6Myj78NfZ1vxmyxJSk5GC6P*5U*UaoKboqeUWnNROFnaSlc6k*39To!*AJfs8bu9uQRrw64Ex!KStY9jcLsMvsyG6DDRIN8ql3l0s9IyfVhO0gYL31*Ojqag87exiNp0l4r5Ofj9m4q9houBtdpQnuKyJiLWa6nB7suSeOMUjczbbWN4e56BSYrZgcDZmhpq!zPhOOHi7YakqsRjkEOFf*vvl6PXt1PbrwgYze9I7hsxFviTGa7eG3T!nittqORFKQt7WNRDHjnn1sZJc",
-#     )
-#     assert len(process_messages()) > 0
+def test_download_attachments_retries_failed_sub_requests(monkeypatch):
+    batches = []
+
+    def api_batch_request(sub_requests):
+        batches.append([sub_request["id"] for sub_request in sub_requests])
+        return {
+            "responses": [
+                (
+                    {
+                        "id": sub_request["id"],
+                        "status": 429,
+                        "headers": {"Retry-After": "0"},
+                    }
+                    if len(batches) == 1 and sub_request["id"] == "1"
+                    else {
+                        "id": sub_request["id"],
+                        "status": 200,
+                        "body": {
+                            "value": [
+                                {
+                                    "@odata.type": "#microsoft.graph.fileAttachment",
+                                    "name": "test.xlsx",
+                                    "contentBytes": base64.b64encode(b"Test Content"),
+                                }
+                            ]
+                        },
+                    }
+                )
+                for sub_request in sub_requests
+            ]
+        }
+
+    monkeypatch.setattr(src.app, "api_batch_request", api_batch_request)
+    messages = [
+        Message(
+            str(message_index),
+            "Test",
+            Body("Test", "text"),
+            EmailAddress("Tester", "test@gmail.com"),
+            EmailAddress("Tester", "test@gmail.com"),
+            [EmailAddress("Tester", "test@gmail.com")],
+            True,
+            datetime.datetime.now().isoformat(),
+        )
+        for message_index in range(3)
+    ]
+    download_attachments(messages)
+    assert batches == [["0", "1", "2"], ["1"]]
+    assert all(len(message.attachments) == 1 for message in messages)
+
+
+def test_download_message_attachments_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.app, "OUTPUT_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(
+        src.app,
+        "CONFIG",
+        OmegaConf.create({"app_config": {"days": 1, "max_workers": 2}}),
+    )
+    messages = [
+        Message(
+            str(message_index),
+            "Test",
+            Body("Test", "text"),
+            EmailAddress("Tester", "test@gmail.com"),
+            EmailAddress("Tester", "test@gmail.com"),
+            [EmailAddress("Tester", "test@gmail.com")],
+            True,
+            datetime.datetime.now().isoformat(),
+        )
+        for message_index in range(6)
+    ]
+
+    def download_attachments(batch: List[Message]):
+        for message in batch:
+            message.attachments = [
+                Attachment(message.id + ".xlsx", None, "A" + message.id, size=12)
+            ]
+
+    lock = threading.Lock()
+    downloads = {"active": 0, "max_active": 0, "names": []}
+
+    def download_attachment_content(message_attachment):
+        with lock:
+            downloads["active"] += 1
+            downloads["max_active"] = max(downloads["max_active"], downloads["active"])
+            downloads["names"].append(message_attachment[1].name)
+        time.sleep(0.05)
+        with lock:
+            downloads["active"] -= 1
+
+    monkeypatch.setattr(src.app, "download_attachments", download_attachments)
+    monkeypatch.setattr(
+        src.app, "download_attachment_content", download_attachment_content
+    )
+    assert download_message_attachments(messages) == 6
+    # Every attachment is downloaded, at most max_workers at a time
+    assert sorted(downloads["names"]) == [
+        str(message_index) + ".xlsx" for message_index in range(6)
+    ]
+    assert downloads["max_active"] == 2
+
+    # A failure in one of the workers is raised to the caller
+    def download_attachment_content_failing(message_attachment):
+        if message_attachment[1].name == "3.xlsx":
+            raise ConnectionError("Download failed")
+
+    monkeypatch.setattr(
+        src.app, "download_attachment_content", download_attachment_content_failing
+    )
+    with pytest.raises(ConnectionError, match="Download failed"):
+        download_message_attachments(messages)
+
+
+def test_save_delta_link(tmp_path, monkeypatch):
+    configure_logging()
+    monkeypatch.setattr(
+        src.app, "DELTA_LINK_PATH", os.path.join(tmp_path, "cache", "delta.json")
+    )
+    assert load_delta_link() == ""
+
+    monkeypatch.setattr(src.app, "PENDING_DELTA_LINK", "https://delta?token=1")
+    save_delta_link()
+    assert load_delta_link() == "https://delta?token=1"
+
+
+def test_append_messages_skips_removed_messages():
+    messages: List[Message] = []
+    append_messages(
+        {"value": [{"id": "1", "@removed": {"reason": "deleted"}}]}, messages
+    )
+    assert len(messages) == 0
+
+
+def test_append_attachments_metadata():
+    response = {
+        "value": [
+            {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "id": "A1",
+                "name": "Offer.XLSX",
+                "contentType": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                "size": 1024,
+            },
+            {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "id": "A2",
+                "name": "logo.png",
+                "contentType": "image/png",
+                "size": 2048,
+            },
+        ]
+    }
+    message: Message = Message(
+        "1",
+        "Test",
+        Body("Test", "text"),
+        EmailAddress("Tester", "test@gmail.com"),
+        EmailAddress("Tester", "test@gmail.com"),
+        [EmailAddress("Tester", "test@gmail.com")],
+        True,
+        datetime.datetime.now().isoformat(),
+    )
+    append_attachments(response, message)
+    assert [attachment.id for attachment in message.attachments] == ["A1", "A2"]
+    assert message.attachments[0].content is None
+    assert [attachment.is_excel_file for attachment in message.attachments] == [
+        True,
+        False,
+    ]
+
+
+class StreamedResponse:
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield b"Test "
+        yield b"Content"
+
+
+def test_download_attachment_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.app, "api_stream_request", lambda url: StreamedResponse())
+    monkeypatch.setattr(
+        src.blob_store, "BLOB_STORE_DIRECTORY", os.path.join(tmp_path, "blobs")
+    )
+    message: Message = Message(
+        "1",
+        "Test",
+        Body("Test", "text"),
+        EmailAddress("Tester", "test@gmail.com"),
+        EmailAddress("Tester", "test@gmail.com"),
+        [EmailAddress("Tester", "test@gmail.com")],
+        True,
+        datetime.datetime.now().isoformat(),
+    )
+    attachment = Attachment(
+        "test.xlsx", None, "A1", path=os.path.join(tmp_path, "Attachments", "test.xlsx")
+    )
+    download_attachment_content((message, attachment))
+    assert attachment.content == b"Test Content"
+
+
+def test_download_attachment_content_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.app, "api_stream_request", lambda url: StreamedResponse())
+    monkeypatch.setattr(
+        src.blob_store, "BLOB_STORE_DIRECTORY", os.path.join(tmp_path, "blobs")
+    )
+    monkeypatch.setattr(src.app, "OUTPUT_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(
+        src.app, "CONFIG", OmegaConf.create({"app_config": {"days": 1}})
+    )
+    message: Message = Message(
+        "1",
+        "Test",
+        Body("Test", "text"),
+        EmailAddress("Tester", "test@gmail.com"),
+        EmailAddress("Tester", "test@gmail.com"),
+        [EmailAddress("Tester", "test@gmail.com")],
+        True,
+        datetime.datetime.now().isoformat(),
+    )
+    message.has_excel_files = True
+    attachment = Attachment("test.xlsx", None, "A1", size=12)
+    message.attachments = [attachment]
+
+    download_attachment_content((message, attachment))
+    assert attachment.is_in_memory
+    assert not os.path.exists(os.path.join(tmp_path, "blobs"))
+
+    # Archived in the background while the attachment is analysed from memory
+    save_messages([message])
+    wait_for_archived_attachments()
+    assert attachment.is_in_memory
+    with open(attachment.path, "rb") as file:
+        assert file.read() == b"Test Content"
+
+    # Archiving can be turned off
+    monkeypatch.setattr(
+        src.app,
+        "CONFIG",
+        OmegaConf.create({"app_config": {"days": 1, "archive_attachments": False}}),
+    )
+    attachment = Attachment("test.xlsx", b"Test Content", "A1", size=12)
+    message.attachments = [attachment]
+    save_messages([message], 1)
+    assert attachment.path is None
+    assert attachment.content == b"Test Content"
 
 
 # def test_generate_inventory_model():
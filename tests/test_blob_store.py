@@ -0,0 +1,31 @@
+import hashlib
+import os
+
+import src.blob_store
+from src.blob_store import store_chunks, store_bytes, link_blob, get_blob_path
+
+
+def test_store_chunks_deduplicates(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.blob_store, "BLOB_STORE_DIRECTORY", os.path.join(tmp_path, "blobs")
+    )
+    content_hash = store_chunks([b"Test ", b"Content"])
+    assert content_hash == hashlib.sha256(b"Test Content").hexdigest()
+    assert store_bytes(b"Test Content") == content_hash
+    assert os.listdir(os.path.join(tmp_path, "blobs", content_hash[:2])) == [
+        content_hash
+    ]
+    assert os.listdir(os.path.join(tmp_path, "blobs", "tmp")) == []
+
+
+def test_link_blob(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.blob_store, "BLOB_STORE_DIRECTORY", os.path.join(tmp_path, "blobs")
+    )
+    content_hash = store_bytes(b"Test Content")
+    path = os.path.join(tmp_path, "Message 1", "Attachments", "test.xlsx")
+    link_blob(content_hash, path)
+    link_blob(content_hash, path)
+    with open(path, "rb") as file:
+        assert file.read() == b"Test Content"
+    assert os.path.samefile(path, get_blob_path(content_hash))
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from src.header_analyser import (
+    AssistantHeaderAnalyser,
+    BatchHeaderAnalyser,
+    ChatHeaderAnalyser,
+    MultiSheetHeaderAnalyser,
+    RateLimiter,
+    parse_response,
+    parse_sheets_response,
+)
+from tests.helpers import (
+    FakeCompletions,
+    FakeSheetsCompletions,
+    create_batch_output,
+    create_client,
+)
+
+RESPONSE = {"barcode": "EAN", "quantity": "Qty", "product": "Description", "price": ""}
+
+
+def test_parse_response():
+    assert parse_response('```json\n{"barcode": "EAN", "quantity": "Qty"}\n```') == {
+        "barcode": "EAN",
+        "quantity": "Qty",
+        "product": "",
+        "price": "",
+    }
+    assert parse_response("Sorry, I couldn't find the headers") is None
+
+
+def test_chat_header_analyser():
+    completions = FakeCompletions(json.dumps(RESPONSE))
+    header_analyser = ChatHeaderAnalyser(create_client(completions), json_schema=True)
+    assert header_analyser.analyse("Qty,Description,EAN\n") == (True, RESPONSE)
+    request = completions.requests[0]
+    assert request["response_format"]["type"] == "json_schema"
+    assert request["messages"][1]["content"].endswith("Qty,Description,EAN\n")
+
+    # A truncated completion means the analysis didn't complete
+    completions = FakeCompletions('{"barcode": "EA', finish_reason="length")
+    header_analyser = ChatHeaderAnalyser(create_client(completions))
+    assert header_analyser.analyse("Qty,Description,EAN\n") == (False, None)
+
+
+def test_parse_sheets_response():
+    assert parse_sheets_response(json.dumps({"2": RESPONSE, "3": "EAN"}), 3) == [
+        None,
+        RESPONSE,
+        None,
+    ]
+    assert parse_sheets_response("[]", 2) == [None, None]
+
+
+def test_multi_sheet_header_analyser():
+    completions = FakeSheetsCompletions(RESPONSE)
+    header_analyser = MultiSheetHeaderAnalyser(
+        create_client(completions), json_schema=True
+    )
+    csv_contents = [f"0,1\nQty,EAN\n{index},3395019917775\n" for index in range(3)]
+
+    header_analyser.start_collecting()
+    for csv_content in csv_contents:
+        assert header_analyser.analyse(csv_content) == (False, None)
+    header_analyser.submit()
+    header_analyser.stop_collecting()
+
+    # All the sheets are sent in a single request
+    assert len(completions.requests) == 1
+    request = completions.requests[0]
+    assert "### Sheet 3\n" + csv_contents[2] in request["messages"][1]["content"]
+    assert request["response_format"]["json_schema"]["schema"]["required"] == [
+        "1",
+        "2",
+        "3",
+    ]
+    for csv_content in csv_contents:
+        assert header_analyser.analyse(csv_content) == (True, RESPONSE)
+    assert len(completions.requests) == 1
+
+    # Sheets that weren't collected are sent on their own
+    assert header_analyser.analyse("0\nQty\n")[0]
+    assert len(completions.requests) == 2
+
+
+def test_multi_sheet_header_analyser_token_budget():
+    completions = FakeSheetsCompletions(RESPONSE)
+    header_analyser = MultiSheetHeaderAnalyser(
+        create_client(completions), max_concurrency=1, max_tokens=10
+    )
+    header_analyser.start_collecting()
+    for index in range(3):
+        header_analyser.analyse(f"0,1\nQty,EAN\n{index},3395019917775\n")
+    header_analyser.submit()
+    # Each sheet is about 7 tokens, so only one fits in a request
+    assert len(completions.requests) == 3
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(max_concurrency=2, requests_per_minute=600)
+    start = time.monotonic()
+    for _ in range(3):
+        with rate_limiter:
+            pass
+    # Requests are spaced 0.1 seconds apart
+    assert time.monotonic() - start >= 0.2
+
+
+def test_batch_header_analyser():
+    batch_inputs = []
+
+    def run_batch(batch_input: str):
+        batch_inputs.append(batch_input)
+        # The second prompt failed and is missing from the output
+        return create_batch_output(batch_input.splitlines()[0], RESPONSE)
+
+    header_analyser = BatchHeaderAnalyser(None, run_batch=run_batch)
+    assert header_analyser.analyse("Qty,Description,EAN\n") == (False, None)
+    assert header_analyser.analyse("Quantity,Product\n") == (False, None)
+    assert header_analyser.has_pending_prompts()
+
+    header_analyser.submit()
+    assert not header_analyser.has_pending_prompts()
+    assert len(batch_inputs[0].splitlines()) == 2
+    assert json.loads(batch_inputs[0].splitlines()[0])["url"] == "/v1/chat/completions"
+    assert header_analyser.analyse("Qty,Description,EAN\n") == (True, RESPONSE)
+    assert header_analyser.analyse("Quantity,Product\n") == (False, None)
+    assert not header_analyser.has_pending_prompts()
+
+
+class FakeAssistants:
+
+    def __init__(self):
+        self.created = []
+        self.deleted = []
+
+    def create(self, **assistant):
+        self.created.append(assistant)
+        return SimpleNamespace(id=f"asst_{len(self.created)}")
+
+    def delete(self, assistant_id: str):
+        self.deleted.append(assistant_id)
+
+
+def test_assistant_header_analyser(tmp_path):
+    assistants = FakeAssistants()
+    client = SimpleNamespace(beta=SimpleNamespace(assistants=assistants))
+    path = os.path.join(tmp_path, "assistant.json")
+
+    assert AssistantHeaderAnalyser(client, "model", path).get_assistant_id() == "asst_1"
+    # Later runs reuse the saved assistant
+    assert AssistantHeaderAnalyser(client, "model", path).get_assistant_id() == "asst_1"
+    assert len(assistants.created) == 1
+
+    # A different model replaces the assistant
+    header_analyser = AssistantHeaderAnalyser(client, "other-model", path)
+    assert header_analyser.get_assistant_id() == "asst_2"
+    assert assistants.deleted == ["asst_1"]
+    assert assistants.created[1]["model"] == "other-model"
@@ -0,0 +1,44 @@
+import os
+import time
+
+from src.header_cache import HeaderCache, get_fingerprint
+
+HEADER_ROWS = [
+    [None, None, None],
+    ["Qty", "Description", "Barcode"],
+    [300, "Sample Decléor 30ml Antidote Serum", 3395019917775],
+]
+RESPONSE = {"barcode": "Barcode", "quantity": "Qty", "product": "Description"}
+
+
+def test_get_fingerprint():
+    next_week_rows = HEADER_ROWS[:2] + [[1284, "Sample Cica Balm", 3395019909718]]
+    assert get_fingerprint(HEADER_ROWS) == get_fingerprint(next_week_rows)
+    assert get_fingerprint(HEADER_ROWS) != get_fingerprint(
+        HEADER_ROWS, "tester@gmail.com"
+    )
+    assert get_fingerprint([[1, 2, 3], [4, 5, 6]]) is None
+
+
+def test_header_cache(tmp_path):
+    path = os.path.join(tmp_path, "header_cache.json")
+    header_cache = HeaderCache(path, max_entries=2)
+    assert header_cache.get("layout-1") is None
+
+    header_cache.put("layout-1", RESPONSE)
+    header_cache.put("layout-2", RESPONSE)
+    assert header_cache.get("layout-1") == RESPONSE
+    # Least recently used layout is evicted first
+    header_cache.put("layout-3", RESPONSE)
+    assert header_cache.get("layout-2") is None
+    assert (header_cache.hits, header_cache.misses) == (1, 2)
+
+    header_cache.save()
+    assert HeaderCache(path).get("layout-3") == RESPONSE
+
+
+def test_header_cache_ttl(tmp_path):
+    header_cache = HeaderCache(os.path.join(tmp_path, "header_cache.json"), ttl_days=1)
+    header_cache.put("layout-1", RESPONSE)
+    header_cache.entries["layout-1"]["saved_at"] = time.time() - 2 * 24 * 60 * 60
+    assert header_cache.get("layout-1") is None
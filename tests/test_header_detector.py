@@ -0,0 +1,34 @@
+from src.header_detector import detect_headers_locally, is_gtin
+from tests.helpers import SHEET_ROWS
+
+
+def test_is_gtin():
+    assert is_gtin(3395019917775)
+    assert is_gtin("3395019917775")
+    assert not is_gtin(3395019917776)
+    # A GTIN-13 starting with zero loses its leading digit when stored as a number
+    assert is_gtin(12345678905)
+    assert not is_gtin(12.95)
+    assert not is_gtin("Sample Cica Balm")
+
+
+def test_detect_headers_locally():
+    response, confidence = detect_headers_locally(SHEET_ROWS)
+    assert response == {
+        "barcode": "EAN",
+        "quantity": "Qty",
+        "product": "Description",
+        "price": "Sale Price £",
+    }
+    assert confidence > 0.9
+
+
+def test_detect_headers_locally_unknown_headers():
+    rows = [["Ref", "Lot", "Col A"], ["A-100", "L1", 3]]
+    response, confidence = detect_headers_locally(rows)
+    assert confidence == 0
+    assert all(header == "" for header in response.values())
+
+    # Values that don't look like the header lower the confidence
+    rows = [["Barcode", "Description"], ["N/A", 300], ["N/A", 1284]]
+    assert detect_headers_locally(rows)[1] < 0.5
@@ -0,0 +1,25 @@
+from src.http_client import (
+    JitteredRetry,
+    BACKOFF_JITTER,
+    create_session,
+    get_session,
+)
+
+
+def test_create_session_pool_sizes():
+    session = create_session({"https://graph.microsoft.com/": 3})
+    adapter = session.get_adapter("https://graph.microsoft.com/v1.0/me/messages")
+    assert adapter._pool_maxsize == 3
+    assert adapter.max_retries.respect_retry_after_header
+
+
+def test_get_session_is_shared():
+    assert get_session() is get_session()
+
+
+def test_jittered_retry_backoff():
+    retry = JitteredRetry(total=5, backoff_factor=1)
+    assert retry.get_backoff_time() == 0
+
+    retry = retry.increment(method="GET", url="/").increment(method="GET", url="/")
+    assert 2 <= retry.get_backoff_time() <= 2 + BACKOFF_JITTER
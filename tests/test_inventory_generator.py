@@ -1,3 +1,599 @@
+import datetime
+import os
+
+import numpy as np
+import openpyxl
+from loguru import logger
+from omegaconf import OmegaConf
+
+import src.analysis_cache
+import src.header_analyser
+import src.inventory_generator
+from src.analysis_cache import load_analysis, save_analysis
+from src.inventory_generator import (
+    analyse_attachment,
+    analyse_attachment_or_load,
+    calculate_table_matrix_indices,
+    detect_headers,
+    extract_rows,
+    extract_workbook,
+    generate_inventory,
+    get_attachment_analysis_key,
+    parse_workbook,
+    read_head_rows,
+)
+from src.models.attachment import Attachment
+from src.models.message import Message, Body, EmailAddress
+from src.models.sheet_analysis import SheetAnalysis
+from src.workbook_reader import read_sheets, stream_sheets
+from tests.helpers import (
+    SHEET_ROWS,
+    FakeSheetsCompletions,
+    create_batch_output,
+    create_client,
+)
+
+TEST_ATTACHMENT_PATH = os.path.join(os.path.dirname(__file__), "test-attachment.xlsx")
+TEST_ATTACHMENT_HEADERS = {
+    "barcode": "Barcode",
+    "quantity": "Qty",
+    "product": "Description",
+    "price": "Sale Price £",
+}
+
+
+def create_message(message_index: int):
+    message = Message(
+        str(message_index),
+        "Test",
+        Body("Test", "text"),
+        EmailAddress("Tester", "test@gmail.com"),
+        EmailAddress("Tester", "test@gmail.com"),
+        [EmailAddress("Tester", "test@gmail.com")],
+        True,
+        datetime.datetime.now().isoformat(),
+    )
+    message.attachments = [
+        Attachment("test-attachment.xlsx", None, path=TEST_ATTACHMENT_PATH)
+    ]
+    return message
+
+
+def test_analyse_attachment(monkeypatch):
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "detect_headers",
+        lambda df, sheet_analysis: TEST_ATTACHMENT_HEADERS,
+    )
+    sheet_analyses = analyse_attachment(TEST_ATTACHMENT_PATH)
+    assert len(sheet_analyses) == 1
+    assert sheet_analyses[0].status == "PROCESSED"
+    assert sheet_analyses[0].items[0] == [
+        3395019917775,
+        300,
+        "Sample Decléor 30ml Antidote Serum",
+        12.95,
+    ]
+    assert len(sheet_analyses[0].items) == 4
+    assert len(sheet_analyses[0].separate_sheet) == 5
+
+
+def test_analyse_attachment_local_headers(monkeypatch):
+    def detect_headers(df, sheet_analysis):
+        raise AssertionError("The assistant shouldn't be called")
+
+    monkeypatch.setattr(src.inventory_generator, "detect_headers", detect_headers)
+    monkeypatch.setattr(src.inventory_generator, "header_detector_confidence", 0.7)
+    sheet_analyses = analyse_attachment(TEST_ATTACHMENT_PATH)
+    assert sheet_analyses[0].status == "PROCESSED"
+    assert len(sheet_analyses[0].items) == 4
+
+
+def test_analyse_attachment_skipped_sheets(tmp_path, monkeypatch):
+    workbook = openpyxl.Workbook()
+    workbook.active.title = "Terms"
+    workbook.active.append(["Terms and conditions"])
+    workbook.active.append(["Prices exclude VAT."])
+    offer_sheet = workbook.create_sheet("Offer")
+    for row in SHEET_ROWS:
+        offer_sheet.append(row)
+    attachment_path = os.path.join(tmp_path, "offer.xlsx")
+    workbook.save(attachment_path)
+
+    analysed_rows = []
+
+    def detect_headers(rows, sheet_analysis):
+        analysed_rows.append(rows)
+        return {
+            "barcode": "EAN",
+            "quantity": "Qty",
+            "product": "Description",
+            "price": "Sale Price £",
+        }
+
+    monkeypatch.setattr(src.inventory_generator, "detect_headers", detect_headers)
+    monkeypatch.setattr(src.inventory_generator, "sheet_classifier", True)
+    sheet_analyses = analyse_attachment(attachment_path)
+
+    # Only the product table is sent to the header analysis
+    assert len(analysed_rows) == 1
+    assert [sheet_analysis.status for sheet_analysis in sheet_analyses] == [
+        "SKIPPED",
+        "PROCESSED",
+    ]
+    assert "single column" in sheet_analyses[0].comments
+    assert len(sheet_analyses[1].items) == 2
+
+    # Skipped sheets are saved in the analysis cache and replayed with the rest
+    monkeypatch.setattr(
+        src.analysis_cache,
+        "ANALYSIS_CACHE_DIRECTORY",
+        os.path.join(tmp_path, "analysis"),
+    )
+    attachment = Attachment("offer.xlsx", None, path=attachment_path)
+    config = OmegaConf.create({"app_config": {}})
+    analyse_attachment_or_load(attachment, None, config)
+    cached_sheet_analyses = load_analysis(
+        get_attachment_analysis_key(attachment, config)
+    )
+    assert [sheet_analysis.status for sheet_analysis in cached_sheet_analyses] == [
+        "SKIPPED",
+        "PROCESSED",
+    ]
+    assert "single column" in cached_sheet_analyses[0].comments
+
+
+def test_detect_headers_short_sheet(monkeypatch):
+    prompts = []
+
+    class HeaderAnalyser:
+        def analyse(self, csv_content):
+            prompts.append(csv_content)
+            return True, {key: "" for key in TEST_ATTACHMENT_HEADERS}
+
+    monkeypatch.setattr(src.inventory_generator, "header_analyser", HeaderAnalyser())
+    monkeypatch.setattr(src.inventory_generator, "header_prompt_tokens", 2000)
+    detect_headers(SHEET_ROWS, SheetAnalysis())
+    # A sheet shorter than 30 rows isn't sent again with 50 rows
+    assert len(prompts) == 1
+    assert prompts[0].startswith("0,1,2,3\nQty,Description,EAN,Sale Price £\n")
+
+
+def test_detect_headers_ragged_sheet(tmp_path, monkeypatch):
+    workbook = openpyxl.Workbook()
+    for row in SHEET_ROWS:
+        workbook.active.append(row)
+    for _ in range(100):
+        workbook.active.append([1, "Sample", 5012345678900, 1.5])
+    # Rows further down are wider than the top of the sheet
+    workbook.active.append([1, "Sample", 5012345678900, 1.5, None, "Discontinued"])
+    attachment_path = os.path.join(tmp_path, "offer.xlsx")
+    workbook.save(attachment_path)
+
+    prompts = []
+
+    class HeaderAnalyser:
+        def analyse(self, csv_content):
+            prompts.append(csv_content)
+            return True, {key: "" for key in TEST_ATTACHMENT_HEADERS}
+
+    monkeypatch.setattr(src.inventory_generator, "header_analyser", HeaderAnalyser())
+    monkeypatch.setattr(src.inventory_generator, "header_cache", None)
+    monkeypatch.setattr(src.inventory_generator, "header_detector_confidence", None)
+    monkeypatch.setattr(src.inventory_generator, "sheet_classifier", False)
+    monkeypatch.setattr(src.inventory_generator, "header_prompt_tokens", None)
+    detect_headers(list(read_sheets(attachment_path).values())[0], SheetAnalysis())
+    for _, get_rows in stream_sheets(attachment_path):
+        detect_headers(read_head_rows(get_rows), SheetAnalysis())
+
+    # The whole sheet and the top of the sheet give the same prompts
+    assert len(prompts) == 4
+    assert prompts[2:] == prompts[:2]
+    assert prompts[0].startswith("0,1,2,3\n")
+
+
+def test_extract_rows():
+    rows = [
+        ["Offer", None, None, None, None],
+        [None, "EAN", "Description", "Qty", "Price"],
+        [None, 3395019917775, "Serum", 300, 12.95],
+        [None, "Unnamed: 1", "Cream 50ml", 24, "n/a"],
+        [None, 3395019917782, 3395019917782, "12.0", "9"],
+        [None, None, "Noise", None, None],
+    ]
+    sheet_analysis = SheetAnalysis()
+    extract_rows(
+        rows,
+        {
+            "barcode": "EAN",
+            "quantity": "Qty",
+            "product": "Description",
+            "price": "Price",
+        },
+        sheet_analysis,
+    )
+    assert sheet_analysis.header_column_index == {
+        "barcode": 1,
+        "product": 2,
+        "quantity": 3,
+        "price": 4,
+    }
+    assert sheet_analysis.items == [
+        [3395019917775, 300, "Serum", 12.95],
+        ["", 24, "Cream 50ml", "n/a"],
+        [3395019917782, 12, "3395019917782", 9.0],
+    ]
+    # The description equal to the barcode is converted along with it
+    assert sheet_analysis.separate_sheet == [
+        ["EAN", "Description", "Qty", "Price"],
+        [3395019917775, "Serum", 300, "12.95"],
+        ["", "Cream 50ml", 24, "n/a"],
+        [3395019917782, 3395019917782, 12, "9"],
+    ]
+
+
+def test_calculate_table_matrix_indices():
+    cells = np.array(
+        [
+            ["", "", "x", "", "", ""],
+            ["", "x", "", "", "x", ""],
+            ["", "x", "", "", "", "x"],
+            ["", "", "", "", "", ""],
+            ["", "", "x", "", "x", ""],
+        ],
+        dtype=object,
+    )
+    table_matrix_indices = {"left": -1, "top": 0, "right": -1}
+    # Header columns count as values, so every row reaches at least columns 2 to 3
+    calculate_table_matrix_indices(
+        table_matrix_indices,
+        cells,
+        {"barcode": 2, "quantity": 3, "product": -1, "price": -1},
+    )
+    # Ties go to the value found first, like statistics.mode
+    assert table_matrix_indices == {"left": 2, "top": 0, "right": 3}
+
+
+def test_generate_inventory(tmp_path, monkeypatch):
+    priced_items = []
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "detect_headers",
+        lambda df, sheet_analysis: TEST_ATTACHMENT_HEADERS,
+    )
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "fetch_prices",
+        lambda items, price_runner_token, system_logger: priced_items.extend(items),
+    )
+    config = OmegaConf.create(
+        {
+            "secrets": {"openai_api_key": "key", "price_runner_token": "token"},
+            "app_config": {"days": 1, "analysis_cache": False, "header_cache": False},
+        }
+    )
+
+    def stream_messages():
+        for message_index in range(2):
+            yield create_message(message_index)
+
+    generate_inventory(str(tmp_path), stream_messages(), logger, config)
+
+    assert len(priced_items) == 8
+    workbook = openpyxl.load_workbook(os.path.join(tmp_path, "Report.xlsx"))
+    assert workbook.sheetnames == [
+        "Summary",
+        "Consolidated",
+        "M-1A-1S-1",
+        "M-2A-1S-1",
+    ]
+
+
+def test_generate_inventory_process_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "detect_headers",
+        lambda rows, sheet_analysis: TEST_ATTACHMENT_HEADERS,
+    )
+    priced_items = {}
+    for parse_workers in [1, 2]:
+        priced_items[parse_workers] = []
+        monkeypatch.setattr(
+            src.inventory_generator,
+            "fetch_prices",
+            lambda items, price_runner_token, system_logger: priced_items[
+                parse_workers
+            ].extend(items),
+        )
+        config = OmegaConf.create(
+            {
+                "secrets": {"openai_api_key": "key", "price_runner_token": "token"},
+                "app_config": {
+                    "days": 1,
+                    "analysis_cache": False,
+                    "header_cache": False,
+                    "parse_workers": parse_workers,
+                },
+            }
+        )
+        output_directory = os.path.join(tmp_path, str(parse_workers))
+        os.makedirs(output_directory)
+        generate_inventory(
+            output_directory,
+            [create_message(message_index) for message_index in range(3)],
+            logger,
+            config,
+        )
+
+    # Workers parse and extract in parallel without changing the order of the results
+    assert [
+        (item.barcode, item.quantity, item.product_description, item.unit_price)
+        for item in priced_items[2]
+    ] == [
+        (item.barcode, item.quantity, item.product_description, item.unit_price)
+        for item in priced_items[1]
+    ]
+    assert len(priced_items[2]) == 12
+    workbook = openpyxl.load_workbook(os.path.join(tmp_path, "2", "Report.xlsx"))
+    assert workbook.sheetnames == [
+        "Summary",
+        "Consolidated",
+        "M-1A-1S-1",
+        "M-2A-1S-1",
+        "M-3A-1S-1",
+    ]
+
+
+def test_parse_workbook(tmp_path, monkeypatch):
+    workbook = openpyxl.Workbook()
+    for row in SHEET_ROWS:
+        workbook.active.append(row)
+    for _ in range(100):
+        workbook.active.append([1, "Sample", 5012345678900, 1.5])
+    attachment_path = os.path.join(tmp_path, "offer.xlsx")
+    workbook.save(attachment_path)
+    response = {
+        "barcode": "EAN",
+        "quantity": "Qty",
+        "product": "Description",
+        "price": "Sale Price £",
+    }
+    monkeypatch.setattr(
+        src.inventory_generator, "detect_headers", lambda rows, sheet_analysis: response
+    )
+    monkeypatch.setattr(src.inventory_generator, "worker_workbooks", {})
+
+    # Only the top of the sheet leaves the worker, until the extracted rows are sent back
+    head_sheets = parse_workbook("workbook", attachment_path)
+    assert [len(rows) for rows in head_sheets] == [70]
+    sheet_analyses = extract_workbook("workbook", [response], [SheetAnalysis()])
+    assert src.inventory_generator.worker_workbooks == {}
+    assert [vars(sheet_analysis) for sheet_analysis in sheet_analyses] == [
+        vars(sheet_analysis) for sheet_analysis in analyse_attachment(attachment_path)
+    ]
+
+
+def test_generate_inventory_streaming(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "detect_headers",
+        lambda rows, sheet_analysis: TEST_ATTACHMENT_HEADERS,
+    )
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "fetch_prices",
+        lambda items, price_runner_token, system_logger: None,
+    )
+    messages = [create_message(message_index) for message_index in range(2)]
+    reports = {}
+    for streaming in [False, True]:
+        config = OmegaConf.create(
+            {
+                "secrets": {"openai_api_key": "key", "price_runner_token": "token"},
+                "app_config": {
+                    "days": 1,
+                    "analysis_cache": False,
+                    "header_cache": False,
+                    "parse_workers": 1,
+                    "streaming": streaming,
+                    "streaming_chunk_rows": 2,
+                },
+            }
+        )
+        output_directory = os.path.join(tmp_path, str(streaming))
+        os.makedirs(output_directory)
+        generate_inventory(output_directory, messages, logger, config)
+        workbook = openpyxl.load_workbook(os.path.join(output_directory, "Report.xlsx"))
+        reports[streaming] = {
+            worksheet.title: [
+                [cell.value for cell in row] for row in worksheet.iter_rows()
+            ]
+            for worksheet in workbook.worksheets
+        }
+
+    # Reading the sheets a few rows at a time gives the same report
+    assert list(reports[True]) == [
+        "Summary",
+        "Consolidated",
+        "M-1A-1S-1",
+        "M-2A-1S-1",
+    ]
+    assert reports[True] == reports[False]
+
+
+def test_generate_inventory_batch(tmp_path, monkeypatch):
+    batch_inputs = []
+
+    def run_local_batch(client, batch_input, poll_seconds):
+        batch_inputs.append(batch_input)
+        return create_batch_output(batch_input, TEST_ATTACHMENT_HEADERS)
+
+    monkeypatch.setattr(src.header_analyser, "run_openai_batch", run_local_batch)
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "fetch_prices",
+        lambda items, price_runner_token, system_logger: None,
+    )
+    config = OmegaConf.create(
+        {
+            "secrets": {"openai_api_key": "key", "price_runner_token": "token"},
+            "app_config": {
+                "days": 1,
+                "analysis_cache": False,
+                "header_cache": False,
+                "header_detector": False,
+                "header_analysis_backend": "batch",
+                "parse_workers": 1,
+            },
+        }
+    )
+
+    messages = [create_message(0), create_message(1)]
+    messages[1].attachments.append(Attachment("broken.xlsx", b"Not a workbook"))
+    generate_inventory(str(tmp_path), messages, logger, config)
+
+    # Both messages have the same sheet, which is sent once in a single batch
+    assert len(batch_inputs) == 1
+    assert len(batch_inputs[0].splitlines()) == 1
+    workbook = openpyxl.load_workbook(os.path.join(tmp_path, "Report.xlsx"))
+    assert workbook["Summary"]["D2"].value == "PROCESSED"
+    assert workbook["Summary"]["D4"].value == "NOT PROCESSED"
+
+
+def test_generate_inventory_multi_sheet(tmp_path, monkeypatch):
+    attachments = []
+    for attachment_index in range(2):
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for sheet_index in range(3):
+            worksheet = workbook.create_sheet(f"Offer {sheet_index}")
+            worksheet.append([f"Offer {attachment_index}-{sheet_index}"])
+            for row in SHEET_ROWS:
+                worksheet.append(row)
+        attachment_path = os.path.join(tmp_path, f"offer-{attachment_index}.xlsx")
+        workbook.save(attachment_path)
+        attachments.append(
+            Attachment(os.path.basename(attachment_path), None, path=attachment_path)
+        )
+    message = create_message(0)
+    message.attachments = attachments + [Attachment("broken.xlsx", b"Not a workbook")]
+
+    read_attachments = []
+
+    def read_attachment_sheets(attachment_file):
+        read_attachments.append(attachment_file)
+        return read_sheets(attachment_file)
+
+    monkeypatch.setattr(src.inventory_generator, "read_sheets", read_attachment_sheets)
+    completions = FakeSheetsCompletions(
+        {
+            "barcode": "EAN",
+            "quantity": "Qty",
+            "product": "Description",
+            "price": "Sale Price £",
+        }
+    )
+    monkeypatch.setattr(
+        src.inventory_generator, "OpenAI", lambda api_key: create_client(completions)
+    )
+    priced_items = []
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "fetch_prices",
+        lambda items, price_runner_token, system_logger: priced_items.extend(items),
+    )
+    config = OmegaConf.create(
+        {
+            "secrets": {"openai_api_key": "key", "price_runner_token": "token"},
+            "app_config": {
+                "days": 1,
+                "analysis_cache": False,
+                "header_cache": False,
+                "header_detector": False,
+                "header_analysis_multi_sheet": True,
+                "parse_workers": 1,
+            },
+        }
+    )
+    generate_inventory(str(tmp_path), [message], logger, config)
+
+    # The six sheets of both attachments are analysed in a single request
+    assert len(completions.requests) == 1
+    assert completions.requests[0]["messages"][1]["content"].count("### Sheet ") == 6
+    assert len(priced_items) == 12
+    # Each attachment is read once, and the one that can't be read is reported
+    assert len(read_attachments) == 3
+    workbook = openpyxl.load_workbook(os.path.join(tmp_path, "Report.xlsx"))
+    assert workbook["Summary"]["D8"].value == "NOT PROCESSED"
+
+
+def test_analysis_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.analysis_cache, "ANALYSIS_CACHE_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(
+        src.inventory_generator,
+        "detect_headers",
+        lambda df, sheet_analysis: TEST_ATTACHMENT_HEADERS,
+    )
+    sheet_analyses = analyse_attachment(TEST_ATTACHMENT_PATH)
+    assert load_analysis("hash") is None
+
+    save_analysis("hash", sheet_analyses)
+    cached_sheet_analyses = load_analysis("hash")
+    assert [vars(sheet_analysis) for sheet_analysis in cached_sheet_analyses] == [
+        vars(sheet_analysis) for sheet_analysis in sheet_analyses
+    ]
+
+
+def test_analyse_attachment_or_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.analysis_cache,
+        "ANALYSIS_CACHE_DIRECTORY",
+        os.path.join(tmp_path, "analysis"),
+    )
+    workbook = openpyxl.Workbook()
+    workbook.active.title = "Stock"
+    for row in openpyxl.load_workbook(TEST_ATTACHMENT_PATH).active.iter_rows(
+        values_only=True
+    ):
+        workbook.active.append(row)
+    offer_sheet = workbook.create_sheet("Offer")
+    for row in SHEET_ROWS:
+        offer_sheet.append(row)
+    attachment_path = os.path.join(tmp_path, "offer.xlsx")
+    workbook.save(attachment_path)
+    attachment = Attachment("offer.xlsx", None, path=attachment_path)
+
+    analysed_rows = []
+
+    def detect_headers(rows, sheet_analysis):
+        analysed_rows.append(rows)
+        return TEST_ATTACHMENT_HEADERS
+
+    monkeypatch.setattr(src.inventory_generator, "detect_headers", detect_headers)
+    # Only the offer sheet is labelled well enough for the local header detection
+    monkeypatch.setattr(src.inventory_generator, "header_detector_confidence", 0.99)
+    config = OmegaConf.create({"app_config": {}})
+    sheet_analyses = analyse_attachment_or_load(attachment, None, config)
+    assert len(analysed_rows) == 1
+
+    # Both sheets are replayed without reading the workbook
+    def read_sheets(attachment_file):
+        raise AssertionError("The workbook shouldn't be read")
+
+    with monkeypatch.context() as context:
+        context.setattr(src.inventory_generator, "read_sheets", read_sheets)
+        cached_sheet_analyses = analyse_attachment_or_load(attachment, None, config)
+    assert len(analysed_rows) == 1
+    assert [vars(sheet_analysis) for sheet_analysis in cached_sheet_analyses] == [
+        vars(sheet_analysis) for sheet_analysis in sheet_analyses
+    ]
+
+    # Analyses saved with other settings aren't replayed
+    config.app_config.header_analysis_model = "other-model"
+    analyse_attachment_or_load(attachment, None, config)
+    assert len(analysed_rows) == 2
+
+
 # import os
 # from datetime import datetime
 # from typing import List
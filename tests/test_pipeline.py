@@ -0,0 +1,34 @@
+import pytest
+
+from src.pipeline import Pipeline
+
+
+def test_pipeline_stages():
+    results = []
+    pipeline = Pipeline(queue_size=2)
+    number_queue = pipeline.add_source(range(10))
+    square_queue = pipeline.add_stage(
+        number_queue, lambda number, emit: emit(number * number)
+    )
+    pipeline.add_stage(
+        square_queue,
+        lambda square, emit: results.append(square),
+        lambda emit: results.append("finished"),
+        has_output=False,
+    )
+    pipeline.join()
+    assert results == [number * number for number in range(10)] + ["finished"]
+
+
+def test_pipeline_failure_does_not_block():
+    def process(number, emit):
+        if number == 3:
+            raise ValueError("Noisy number")
+        emit(number)
+
+    pipeline = Pipeline(queue_size=1)
+    number_queue = pipeline.add_source(range(100))
+    result_queue = pipeline.add_stage(number_queue, process)
+    pipeline.add_stage(result_queue, lambda number, emit: None, has_output=False)
+    with pytest.raises(ValueError):
+        pipeline.join()
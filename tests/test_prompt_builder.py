@@ -0,0 +1,42 @@
+from src.prompt_builder import build_prompt, restore_headers
+
+LONG_HEADER = "Product description as shown on the supplier's website"
+
+
+def test_build_prompt():
+    rows = [
+        [None, None, None, None],
+        ["Qty", None, LONG_HEADER, "EAN"],
+        [300, None, "Sample Decléor 30ml Antidote Serum", 3395019917775],
+    ]
+    csv_content, original_texts = build_prompt(rows, 30)
+    # The empty row and column are left out, but the column numbers are kept
+    assert csv_content == (
+        "0,2,3\n"
+        "Qty,Product description as shown on the supp,EAN\n"
+        "300,Sample Decléor 30ml Antidote Serum,3395019917775\n"
+    )
+
+    response = {
+        "barcode": "EAN",
+        "quantity": "Qty",
+        "product": "Product description as shown on the supp",
+        "price": "",
+    }
+    assert restore_headers(response, original_texts) == {
+        "barcode": "EAN",
+        "quantity": "Qty",
+        "product": LONG_HEADER,
+        "price": "",
+    }
+
+
+def test_build_prompt_token_budget():
+    rows = [["Qty", "EAN"]] + [[index, 3395019917775] for index in range(50)]
+    csv_content, _ = build_prompt(rows, 50, max_tokens=20)
+    assert len(csv_content) <= 20 * 4
+    assert csv_content.startswith("0,1\nQty,EAN\n0,3395019917775\n")
+
+    # The first row is always sent
+    csv_content, _ = build_prompt(rows, 50, max_tokens=1)
+    assert csv_content == "0,1\nQty,EAN\n"
@@ -0,0 +1,32 @@
+from src.sheet_classifier import get_skip_reason
+from tests.helpers import SHEET_ROWS
+
+
+def test_get_skip_reason_product_table():
+    assert get_skip_reason(SHEET_ROWS) is None
+    # Tables without barcodes are still analysed when they have a column of numbers
+    rows = [["Item", "Stock", "Cost"], ["Cica Balm", 1284, "€12.50"]]
+    assert get_skip_reason(rows) is None
+
+
+def test_get_skip_reason():
+    cover_page = [[None, None], [None, "Stock offer - March"]]
+    assert "less than two rows" in get_skip_reason(cover_page)
+
+    terms = [
+        ["Terms and conditions"],
+        ["1. Prices exclude VAT."],
+        ["2. Payment is due before delivery."],
+    ]
+    assert "single column" in get_skip_reason(terms)
+
+    contacts = [["Contact", "Email"], ["Sales", "sales@example.com"]]
+    assert "only has text" in get_skip_reason(contacts)
+
+    notes = [
+        ["Version", "Notes"],
+        [2, "Updated the delivery terms"],
+        ["Delivery", "Within 5 working days"],
+        ["Payment", "Bank transfer"],
+    ]
+    assert "mostly numbers" in get_skip_reason(notes)
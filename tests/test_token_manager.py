@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+import src.token_manager
+from src.token_manager import FileLock, TokenManager
+
+
+class FakePublicClientApplication:
+
+    def __init__(self, client_id, authority, token_cache):
+        self.refresh_count = 0
+        self.error = None
+
+    def get_accounts(self):
+        return [{"username": "tester@gmail.com"}]
+
+    def acquire_token_silent(self, scopes, account, force_refresh):
+        if self.error is not None:
+            return {"error": "invalid_grant", "error_description": self.error}
+        self.refresh_count += 1
+        return {
+            "access_token": "access_token_" + str(self.refresh_count),
+            "expires_in": 3600,
+        }
+
+
+def test_file_lock(tmp_path):
+    lock_path = os.path.join(tmp_path, "cache.lock")
+    with FileLock(lock_path):
+        assert os.path.exists(lock_path)
+        with pytest.raises(TimeoutError):
+            with FileLock(lock_path, timeout=0.2):
+                pass
+    assert not os.path.exists(lock_path)
+
+
+def test_token_manager_refreshes_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.token_manager, "PublicClientApplication", FakePublicClientApplication
+    )
+    token_manager = TokenManager(
+        "client_id", ["Mail.Read"], os.path.join(tmp_path, "token_cache.bin")
+    )
+    assert token_manager.sign_in()["access_token"] == "access_token_1"
+    assert token_manager.get_access_token() == "access_token_1"
+
+    token_manager.refresh("access_token_1")
+    token_manager.refresh("access_token_1")
+    assert token_manager.get_access_token() == "access_token_2"
+
+    # Tokens close to expiry are refreshed before they are handed out
+    token_manager.expires_at = time.time() + 60
+    assert token_manager.get_access_token() == "access_token_3"
+
+
+def test_token_manager_refresh_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.token_manager, "PublicClientApplication", FakePublicClientApplication
+    )
+    token_manager = TokenManager(
+        "client_id", ["Mail.Read"], os.path.join(tmp_path, "token_cache.bin")
+    )
+    token_manager.sign_in()
+    token_manager.app.error = "The refresh token has expired."
+    token_manager.expires_at = time.time() + 60
+    with pytest.raises(Exception, match="The refresh token has expired."):
+        token_manager.get_access_token()
+    with pytest.raises(Exception, match="The refresh token has expired."):
+        token_manager.refresh("access_token_1")
+
+
+def test_token_manager_save_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        src.token_manager, "PublicClientApplication", FakePublicClientApplication
+    )
+    cache_path = os.path.join(tmp_path, "cache", "token_cache.bin")
+    token_manager = TokenManager("client_id", ["Mail.Read"], cache_path)
+    token_manager.cache.has_state_changed = True
+    token_manager.save_cache()
+    assert os.stat(cache_path).st_mode & 0o777 == 0o600
+    assert not token_manager.cache.has_state_changed
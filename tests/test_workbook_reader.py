@@ -0,0 +1,102 @@
+import datetime
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import openpyxl
+
+import src.workbook_reader
+from src.workbook_reader import pad_rows, read_sheets, stream_sheets, write_csv
+
+TEST_ATTACHMENT_PATH = os.path.join(os.path.dirname(__file__), "test-attachment.xlsx")
+# Same rows as the .xlsx attachment with an extra hidden row
+TEST_XLS_ATTACHMENT_PATH = os.path.join(
+    os.path.dirname(__file__), "test-attachment.xls"
+)
+
+
+def test_read_sheets():
+    sheets = read_sheets(TEST_ATTACHMENT_PATH)
+    rows = list(sheets.values())[0]
+    assert rows[0] == [None, None, None, None, None]
+    assert rows[1] == ["Qty", "Description", "Barcode", "RSP", "Sale Price £"]
+    assert rows[3] == [
+        300,
+        "Sample Decléor 30ml Antidote Serum ",
+        3395019917775,
+        67,
+        12.95,
+    ]
+    # Trailing empty rows are dropped
+    assert len(rows) == 7
+
+
+def test_read_sheets_hidden_rows(tmp_path, monkeypatch):
+    path = os.path.join(tmp_path, "hidden-rows.xlsx")
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = "Stock"
+    worksheet["B2"] = "EAN"
+    worksheet["C2"] = "Qty"
+    worksheet["B3"] = "Hidden"
+    worksheet["B5"] = 5000000000001
+    worksheet["C5"] = 10.0
+    worksheet["D5"] = datetime.datetime(2024, 7, 1)
+    worksheet.row_dimensions[3].hidden = True
+    workbook.create_sheet("Empty")
+    workbook.save(path)
+
+    sheets = read_sheets(path)
+    assert list(sheets.keys()) == ["Stock", "Empty"]
+    assert sheets["Stock"] == [
+        [None, None, None, None],
+        [None, "EAN", "Qty", None],
+        [None, None, None, None],
+        [None, 5000000000001, 10, datetime.datetime(2024, 7, 1)],
+    ]
+    assert sheets["Empty"] == []
+
+    # Without the private parser of openpyxl, the hidden rows are read too
+    attachment_sheets = read_sheets(TEST_ATTACHMENT_PATH)
+    monkeypatch.setattr(src.workbook_reader, "WorkSheetParser", None)
+    sheets = read_sheets(path)
+    assert sheets["Stock"] == [
+        [None, None, None, None],
+        [None, "EAN", "Qty", None],
+        [None, "Hidden", None, None],
+        [None, None, None, None],
+        [None, 5000000000001, 10, datetime.datetime(2024, 7, 1)],
+    ]
+    assert sheets["Empty"] == []
+    assert read_sheets(TEST_ATTACHMENT_PATH) == attachment_sheets
+
+
+def test_read_xls_sheets():
+    xlsx_rows = list(read_sheets(TEST_ATTACHMENT_PATH).values())[0]
+    # Legacy workbooks can be read by several workers at once
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for sheets in executor.map(read_sheets, [TEST_XLS_ATTACHMENT_PATH] * 4):
+            assert sheets == {"Offer": xlsx_rows}
+
+
+def test_read_sheets_from_memory():
+    for path in [TEST_ATTACHMENT_PATH, TEST_XLS_ATTACHMENT_PATH]:
+        with open(path, "rb") as file:
+            content = file.read()
+        assert read_sheets(io.BytesIO(content)) == read_sheets(path)
+        assert read_sheets(memoryview(content)) == read_sheets(path)
+
+
+def test_stream_sheets():
+    for path in [TEST_ATTACHMENT_PATH, TEST_XLS_ATTACHMENT_PATH]:
+        sheets = read_sheets(path)
+        for sheet_name, get_rows in stream_sheets(path):
+            # The rows can be read again, and only lack the padding
+            assert list(get_rows()) == list(get_rows())
+            assert pad_rows(list(get_rows())) == sheets[sheet_name]
+
+
+def test_write_csv():
+    assert write_csv([["Qty", None, "EAN"], [1, "A, B", 2.5]]) == (
+        '0,1,2\nQty,,EAN\n1,"A, B",2.5\n'
+    )